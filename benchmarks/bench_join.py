@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of joining upload chunks into the assembled file on local storage.
+
+    python benchmarks/bench_join.py --chunks 64 --chunk-size 4194304
+"""
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+settings.configure()
+
+from django.core.files.storage import FileSystemStorage
+
+from cbh_core_model.uploads import LocalComposer, append_local_file, copy_stream
+
+
+def join_in_memory(paths, target):
+    """Reading each chunk whole, as the chunks were joined before they were streamed"""
+    with io.open(target, "wb") as joined:
+        for path in paths:
+            with io.open(path, "rb") as chunk:
+                joined.write(chunk.read())
+
+
+def join_buffered(paths, target):
+    with io.open(target, "wb", buffering=0) as joined:
+        for path in paths:
+            with io.open(path, "rb", buffering=0) as chunk:
+                copy_stream(chunk, joined)
+
+
+def join_zero_copy(paths, target):
+    with io.open(target, "wb", buffering=0) as joined:
+        for path in paths:
+            append_local_file(path, joined)
+
+
+def timed(label, total, func):
+    started = time.time()
+    func()
+    seconds = time.time() - started
+    print("%-18s %8.3fs %10.1f MB/s" % (label, seconds, total / seconds / 1024 / 1024 if seconds else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--directory", default=None, help="Where to write the chunks, defaults to the temporary directory")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="flowjs-bench-", dir=args.directory)
+    try:
+        storage = FileSystemStorage(location=directory)
+        os.makedirs(storage.path("chunks"))
+        names = []
+        for number in range(args.chunks):
+            name = "chunks/%04d" % number
+            with io.open(storage.path(name), "wb") as chunk:
+                chunk.write(os.urandom(args.chunk_size))
+            names.append(name)
+        paths = [storage.path(name) for name in names]
+        total = args.chunks * args.chunk_size
+        zero_copy = getattr(os, "copy_file_range", None) or getattr(os, "sendfile", None)
+        print("%d chunks of %d bytes, kernel copy %s" % (args.chunks, args.chunk_size, "available" if zero_copy else "not available"))
+
+        target = storage.path("joined")
+        timed("in memory", total, lambda: join_in_memory(paths, target))
+        timed("buffered", total, lambda: join_buffered(paths, target))
+        timed("append_local_file", total, lambda: join_zero_copy(paths, target))
+        composer = LocalComposer(storage)
+        timed("composer", total, lambda: composer.compose(names, "composed"))
+        timed("composer + sha256", total, lambda: composer.compose(names, "hashed", digest=hashlib.sha256()))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
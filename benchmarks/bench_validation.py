@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time validate_upload on a generated upload, serially and with a pool of worker processes.
+
+    python benchmarks/bench_validation.py --rows 200000 --workers 4
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+
+settings.configure(
+    USE_TZ=True,
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3"}},
+    INSTALLED_APPS=[
+        "django.contrib.auth",
+        "django.contrib.contenttypes",
+        "django.contrib.sites",
+        "cbh_core_model",
+    ],
+    SITE_ID=1,
+)
+
+import django
+django.setup()
+
+from cbh_core_model.models import PinnedCustomField
+from cbh_core_model import validation
+
+
+FIELDS = [
+    ("Name", PinnedCustomField.TEXT, True),
+    ("Count", PinnedCustomField.INTEGER, False),
+    ("Weight", PinnedCustomField.NUMBER, True),
+    ("Purity", PinnedCustomField.PERCENTAGE, False),
+    ("Made", PinnedCustomField.DATE, False),
+]
+
+
+def make_rows(count, error_rate):
+    """Rows with valid values and the given fraction of bad cells"""
+    rows = []
+    for index in range(count):
+        row = {
+            "Name": "compound %d" % index,
+            "Count": str(index),
+            "Weight": "%.3f" % random.uniform(1, 500),
+            "Purity": "%.1f" % random.uniform(1, 99),
+            "Made": "2016-%02d-%02d" % (index % 12 + 1, index % 28 + 1),
+        }
+        if random.random() < error_rate:
+            row[random.choice(list(row))] = "not valid"
+        rows.append(row)
+    return rows
+
+
+def timed(label, func):
+    started = time.time()
+    result = func()
+    print("%-10s %8.3fs %8d errors" % (label, time.time() - started, len(result)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--block-rows", type=int, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    fields = [PinnedCustomField(name=name, field_type=field_type, required=required) for name, field_type, required in FIELDS]
+    rows = make_rows(args.rows, args.error_rate)
+    print("%d rows, %d fields" % (len(rows), len(fields)))
+
+    serial = timed("serial", lambda: validation.validate_upload(fields, rows, workers=1))
+    #Force the pool whatever the size of the upload so that the two paths can be compared
+    validation.VALIDATION_SERIAL_THRESHOLD = 0
+    pooled = timed("pool", lambda: validation.validate_upload(fields, rows, workers=args.workers, block_rows=args.block_rows))
+    if serial != pooled:
+        sys.exit("The pool returned different errors to the serial validation")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Fill in the materialized path of data form configs saved before the path field existed"""
+from django.core.management.base import BaseCommand
+from django.db.models import Case, CharField, Value, When
+
+from cbh_core_model.models import DataFormConfig, DATA_FORM_LEVELS, get_data_form_path
+
+
+class Command(BaseCommand):
+    help = "Set the materialized path of every data form config whose path does not match its l0 to l4 levels"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+            help="Number of data form configs to update in each batch")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+            help="Report how many paths would be set without changing them")
+
+    def handle(self, *args, **options):
+        updated = 0
+        last_id = 0
+        while True:
+            batch = list(DataFormConfig.objects.filter(pk__gt=last_id).order_by("pk")
+                .values_list("pk", "path", *DATA_FORM_LEVELS)[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            paths = {}
+            for row in batch:
+                path = get_data_form_path(row[2:])
+                if path != row[1]:
+                    paths[row[0]] = path
+            if paths and not options["dry_run"]:
+                # set all of the paths in the batch with one query, save() is not used so no signals are sent
+                DataFormConfig.objects.filter(pk__in=list(paths.keys())).update(path=Case(
+                    *[When(pk=pk, then=Value(path)) for pk, path in paths.items()], output_field=CharField()))
+            updated += len(paths)
+
+        if options["dry_run"]:
+            self.stdout.write("Would set the path of %d data form configs" % updated)
+        else:
+            self.stdout.write("Set the path of %d data form configs" % updated)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Remove stale and abandoned Flow.js uploads along with their chunk files"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from cbh_core_model.models import CBHFlowFile
+from cbh_core_model.uploads import FLOWJS_STALE_UPLOAD_HOURS, SynchronousAssemblyBackend
+
+
+class Command(BaseCommand):
+    help = "Delete uploads which are still uploading, failed or stuck assembling and are older than the given age, along with their chunk files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age-hours", type=float, default=FLOWJS_STALE_UPLOAD_HOURS,
+            help="Remove uploads created more than this many hours ago")
+        parser.add_argument("--batch-size", type=int, default=500,
+            help="Number of uploads to remove in each batch")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+            help="Report what would be removed without deleting anything")
+        parser.add_argument("--requeue-assemblies", action="store_true", default=False,
+            help="Assemble uploads stuck assembling for longer than FLOWJS_ASSEMBLY_TIMEOUT_MINUTES again, in this process")
+        parser.add_argument("--fail-assemblies", action="store_true", default=False,
+            help="Mark uploads stuck assembling for longer than FLOWJS_ASSEMBLY_TIMEOUT_MINUTES as failed")
+
+    def handle(self, *args, **options):
+        if options["requeue_assemblies"] or options["fail_assemblies"]:
+            if options["dry_run"]:
+                self.stdout.write("Would recover %d stuck assemblies" % CBHFlowFile.objects.stuck_assemblies().count())
+            else:
+                # the command exits once it is done so the assemblies are run here rather than on background threads
+                recovered = CBHFlowFile.objects.recover_assemblies(requeue=options["requeue_assemblies"], 
+                    backend=SynchronousAssemblyBackend())
+                self.stdout.write("Recovered %d stuck assemblies" % recovered)
+        removed, reclaimed = CBHFlowFile.objects.collect_stale(timedelta(hours=options["max_age_hours"]),
+            batch_size=options["batch_size"], dry_run=options["dry_run"])
+        if options["dry_run"]:
+            self.stdout.write("Would remove %d uploads and reclaim %d bytes" % (removed, reclaimed))
+        else:
+            self.stdout.write("Removed %d uploads and reclaimed %d bytes" % (removed, reclaimed))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Move existing upload and chunk files into the directory layout chosen by FLOWJS_SHARDED_LAYOUT and record the new layout on each upload"""
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Case, CharField, Value, When
+
+from cbh_core_model.models import CBHFlowFile, CBHFlowFileChunk, flow_chunk_upload_to
+from cbh_core_model.uploads import FLOWJS_SHARDED_LAYOUT, move_stored_file
+
+
+class Command(BaseCommand):
+    help = "Move upload and chunk files written in the other directory layout into the one set by FLOWJS_SHARDED_LAYOUT"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500,
+            help="Number of uploads to move in each batch")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+            help="Report how many files would be moved without moving them")
+
+    def handle(self, *args, **options):
+        sharded = FLOWJS_SHARDED_LAYOUT
+        dry_run = options["dry_run"]
+        files_moved = 0
+        chunks_moved = 0
+        last_id = 0
+        while True:
+            batch = list(CBHFlowFile.objects.filter(pk__gt=last_id).order_by("pk")[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            batch = [flow_file for flow_file in batch if flow_file.sharded_layout != sharded]
+            if not batch:
+                continue
+            for flow_file in batch:
+                # content addressed files are stored by digest and do not depend on the layout
+                if not flow_file.storage_path:
+                    old_path = flow_file.path
+                    if dry_run:
+                        files_moved += default_storage.exists(old_path)
+                    elif move_stored_file(default_storage, old_path, flow_file.get_layout_path(sharded)):
+                        files_moved += 1
+                # the chunk names below are worked out for the new layout
+                flow_file.sharded_layout = sharded
+
+            parents = dict((flow_file.pk, flow_file) for flow_file in batch)
+            renames = {}
+            for chunk in CBHFlowFileChunk.objects.filter(parent_id__in=list(parents)):
+                chunk.parent = parents[chunk.parent_id]
+                new_name = flow_chunk_upload_to(chunk, chunk.filename)
+                if chunk.file.name == new_name:
+                    continue
+                if dry_run:
+                    chunks_moved += default_storage.exists(chunk.file.name)
+                else:
+                    moved_to = move_stored_file(default_storage, chunk.file.name, new_name)
+                    if moved_to:
+                        renames[chunk.pk] = moved_to
+            if not dry_run:
+                CBHFlowFile.objects.filter(pk__in=list(parents)).update(sharded_layout=sharded)
+            if renames:
+                # point all of the moved chunks at their new names with one query per batch
+                CBHFlowFileChunk.objects.filter(pk__in=list(renames.keys())).update(file=Case(
+                    *[When(pk=pk, then=Value(name)) for pk, name in renames.items()], output_field=CharField()))
+                chunks_moved += len(renames)
+
+        layout = "sharded" if sharded else "flat"
+        if dry_run:
+            self.stdout.write("Would move %d upload files and %d chunk files into the %s layout" % (files_moved, chunks_moved, layout))
+        else:
+            self.stdout.write("Moved %d upload files and %d chunk files into the %s layout" % (files_moved, chunks_moved, layout))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Timings and byte counts for each stage of the Flow.js upload pipeline, reported to a pluggable collector
+so that slow uploads can be traced to the chunk writes, the counter updates, assembly or chunk cleanup"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+#Dotted path of the collector class the stage timings are reported to
+FLOWJS_METRICS_COLLECTOR = getattr(settings, "FLOWJS_METRICS_COLLECTOR", "cbh_core_model.metrics.InMemoryCollector")
+#Number of uploads the in memory collector keeps figures for, the oldest are dropped first
+FLOWJS_METRICS_MAX_UPLOADS = getattr(settings, "FLOWJS_METRICS_MAX_UPLOADS", 1000)
+
+CHUNK_WRITE = "chunk_write"
+COUNTER_UPDATE = "counter_update"
+ASSEMBLY = "assembly"
+CHUNK_CLEANUP = "chunk_cleanup"
+#From the creation of an upload until it is completed, includes the time spent sending chunks over the network
+UPLOAD = "upload"
+
+
+class Throughput(object):
+    """Running totals of the calls, seconds and bytes for one stage"""
+    __slots__ = ("count", "seconds", "bytes")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, nbytes):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "bytes_per_second": self.bytes / self.seconds if self.seconds else 0.0,
+        }
+
+
+class NullCollector(object):
+    """Collector that throws the figures away, for switching the instrumentation off"""
+
+    def record(self, stage, seconds, nbytes=0, upload_id=None, project_id=None):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class InMemoryCollector(object):
+    """Keep running totals for each stage overall, per upload and per project in this process"""
+
+    def __init__(self, max_uploads=None):
+        self.max_uploads = max_uploads or FLOWJS_METRICS_MAX_UPLOADS
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.uploads = OrderedDict()
+        self.projects = {}
+
+    def _add(self, table, key, stage, seconds, nbytes):
+        table.setdefault(key, {}).setdefault(stage, Throughput()).add(seconds, nbytes)
+
+    def record(self, stage, seconds, nbytes=0, upload_id=None, project_id=None):
+        with self.lock:
+            self.stages.setdefault(stage, Throughput()).add(seconds, nbytes)
+            if upload_id is not None:
+                self._add(self.uploads, upload_id, stage, seconds, nbytes)
+                while len(self.uploads) > self.max_uploads:
+                    self.uploads.popitem(last=False)
+            if project_id is not None:
+                self._add(self.projects, project_id, stage, seconds, nbytes)
+
+    def stats(self):
+        """Calls, seconds, bytes and bytes per second for each stage, overall, per upload id and per project id"""
+        def stage_dicts(stages):
+            return dict((stage, throughput.as_dict()) for stage, throughput in stages.items())
+        with self.lock:
+            return {
+                "stages": stage_dicts(self.stages),
+                "uploads": dict((key, stage_dicts(stages)) for key, stages in self.uploads.items()),
+                "projects": dict((key, stage_dicts(stages)) for key, stages in self.projects.items()),
+            }
+
+
+class LoggingCollector(InMemoryCollector):
+    """Log each stage timing as it is recorded as well as keeping the in memory totals"""
+
+    def record(self, stage, seconds, nbytes=0, upload_id=None, project_id=None):
+        super(LoggingCollector, self).record(stage, seconds, nbytes, upload_id, project_id)
+        logger.info("flowjs %s upload=%s project=%s bytes=%d seconds=%.4f", stage, upload_id, project_id, nbytes, seconds)
+
+
+_collector = None
+
+
+def get_metrics_collector():
+    """Return the configured metrics collector, created on first use"""
+    global _collector
+    if _collector is None:
+        _collector = import_string(FLOWJS_METRICS_COLLECTOR)()
+    return _collector
+
+
+@contextmanager
+def measure(stage, flow_file=None, nbytes=0):
+    """
+    Time the enclosed block and report it to the collector against the upload and its project.
+    The byte count can be set on the yielded dictionary once it is known, blocks that raise are not reported
+    """
+    measurement = {"bytes": nbytes}
+    started = time.time()
+    yield measurement
+    get_metrics_collector().record(stage, time.time() - started, measurement["bytes"],
+        upload_id=getattr(flow_file, "pk", None), project_id=getattr(flow_file, "project_id", None))
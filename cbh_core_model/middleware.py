@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""Middleware for the upload pipeline"""
+from django.http import HttpResponse
+
+from cbh_core_model.uploads import UploadBackpressure
+
+
+class UploadBackpressureMiddleware(object):
+    """Turn uploads refused by the concurrency limits into a retryable 503 response with a Retry-After header,
+    Flow.js retries chunks which fail with this status"""
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, UploadBackpressure):
+            response = HttpResponse(str(exception), status=exception.status_code, content_type="text/plain")
+            response["Retry-After"] = str(exception.retry_after)
+            return response
+        return None
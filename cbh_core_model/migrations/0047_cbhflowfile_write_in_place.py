@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0046_auto_20160504_0945'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='chunk_size',
+            field=models.IntegerField(default=0, help_text=b'Size in bytes of every chunk apart from the last, used to calculate where each chunk is written'),
+        ),
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='received_chunks',
+            field=models.BinaryField(default=b'', help_text=b'Bitmap of the chunk numbers received so far'),
+        ),
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='write_in_place',
+            field=models.BooleanField(default=False, help_text=b'Whether chunks are written straight to their offset in a preallocated file instead of being stored separately and joined'),
+        ),
+    ]
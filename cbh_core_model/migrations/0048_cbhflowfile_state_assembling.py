@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0047_cbhflowfile_write_in_place'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cbhflowfile',
+            name='state',
+            field=models.IntegerField(choices=[(1, b'Uploading'), (2, b'Completed'), (3, b'Upload Error'), (4, b'Assembling')], default=1, help_text=b'Current status of the upload'),
+        ),
+    ]
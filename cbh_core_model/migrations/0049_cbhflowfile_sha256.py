@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0048_cbhflowfile_state_assembling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, default=None, help_text=b'SHA-256 digest of the assembled file', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='storage_path',
+            field=models.CharField(blank=True, default=None, help_text=b'Path the assembled content is stored at, uploads with identical content share the same path', max_length=500, null=True),
+        ),
+    ]
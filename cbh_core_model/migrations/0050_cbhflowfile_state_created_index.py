@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0049_cbhflowfile_sha256'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='cbhflowfile',
+            index_together=set([('state', 'created')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import cbh_core_model.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0050_cbhflowfile_state_created_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cbhflowfilechunk',
+            name='file',
+            field=models.FileField(max_length=255, upload_to=cbh_core_model.models.flow_chunk_upload_to),
+        ),
+    ]
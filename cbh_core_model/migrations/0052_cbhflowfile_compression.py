@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0051_cbhflowfilechunk_sharded_upload_to'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='compressed_size',
+            field=models.BigIntegerField(blank=True, default=None, help_text=b'Size in bytes of the stored file when compressed', null=True),
+        ),
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='compression',
+            field=models.CharField(blank=True, default=b'', help_text=b'Compression applied to the stored file, gzip, zstd or blank for none', max_length=10),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0052_cbhflowfile_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CBHFlowFilePreview',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_type', models.CharField(help_text=b'Type of file sniffed from the start of the upload, csv, tsv, sdf or xlsx', max_length=10)),
+                ('headers', models.TextField(default=b'[]', help_text=b'JSON list of the column headers, or the data tags of an SD file')),
+                ('rows', models.TextField(default=b'[]', help_text=b'JSON list of the first rows of the file')),
+                ('estimated_row_count', models.IntegerField(default=0, help_text=b'Number of rows or records in the file, estimated from the start of the file when it is large')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text=b'Date the preview was extracted')),
+                ('flow_file', models.OneToOneField(help_text=b'The upload this preview was taken from', on_delete=django.db.models.deletion.CASCADE, related_name='preview', to='cbh_core_model.CBHFlowFile')),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('cbh_core_model', '0053_cbhflowfilepreview'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.IntegerField(help_text=b'Id of the object that was changed')),
+                ('action', models.CharField(choices=[(b'created', b'Created'), (b'updated', b'Updated'), (b'deleted', b'Deleted')], help_text=b'Whether the object was created, updated or deleted', max_length=10)),
+                ('changes', models.TextField(default=b'{}', help_text=b'JSON object mapping each changed field to a list of its old and new values')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text=b'Date the change was recorded')),
+                ('content_type', models.ForeignKey(help_text=b'Type of the object that was changed', on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'ordering': ['created', 'id'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='changelogentry',
+            index_together=set([('content_type', 'object_id')]),
+        ),
+    ]
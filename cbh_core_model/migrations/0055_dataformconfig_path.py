@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0054_changelogentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataformconfig',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default=b'', help_text=b'Materialized path of the l0 to l4 ids that are set, for example 12/7/33, kept up to date on save', max_length=100),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0055_dataformconfig_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='assembly_started',
+            field=models.DateTimeField(blank=True, default=None, help_text=b'Date the current assembly job was queued, used to find assemblies that were lost', null=True),
+        ),
+    ]
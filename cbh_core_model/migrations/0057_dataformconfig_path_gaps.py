@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+LEVELS = ("l0_id", "l1_id", "l2_id", "l3_id", "l4_id")
+
+
+def encode_path(levels):
+    levels = list(levels)
+    while levels and levels[-1] is None:
+        levels.pop()
+    return "/".join("" if value is None else str(value) for value in levels)
+
+
+def reencode_gapped_paths(apps, schema_editor):
+    """Paths used to skip unset levels, rewrite the ones with a gap between set levels using empty segments"""
+    DataFormConfig = apps.get_model('cbh_core_model', 'DataFormConfig')
+    for row in DataFormConfig.objects.exclude(path="").values_list("pk", "path", *LEVELS).iterator():
+        path = encode_path(row[2:])
+        if path != row[1]:
+            DataFormConfig.objects.filter(pk=row[0]).update(path=path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0056_cbhflowfile_assembly_started'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dataformconfig',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default=b'', help_text=b'Materialized path of the l0 to l4 ids with empty segments for unset levels, for example 12/7/33 or 12//33, kept up to date on save', max_length=100),
+        ),
+        migrations.RunPython(reencode_gapped_paths, migrations.RunPython.noop),
+    ]
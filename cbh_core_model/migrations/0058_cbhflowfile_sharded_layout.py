@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_existing_layout(apps, schema_editor):
+    """Uploads made so far used the layout set for the whole site"""
+    if getattr(settings, "FLOWJS_SHARDED_LAYOUT", False):
+        CBHFlowFile = apps.get_model('cbh_core_model', 'CBHFlowFile')
+        CBHFlowFile.objects.update(sharded_layout=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cbh_core_model', '0057_dataformconfig_path_gaps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cbhflowfile',
+            name='sharded_layout',
+            field=models.BooleanField(default=False, help_text=b'Whether the files of this upload are in the sharded directory layout, taken from FLOWJS_SHARDED_LAYOUT when the upload is created'),
+        ),
+        migrations.RunPython(set_existing_layout, migrations.RunPython.noop),
+    ]
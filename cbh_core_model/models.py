@@ -1,17 +1,21 @@
 # -*- coding: utf-8 -*-
 """Core models for ChemBio Hub platform, covering objects required for configuration of the tool such as projects and skinning"""
-from django.db import models, connection
+from django.db import models, connection, connections, transaction
+from django.db.models import F, Q, Case, When, Value
 
 from solo.models import SingletonModel
 from django_extensions.db.models import TimeStampedModel
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, post_init, post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import Permission, User, Group
 from collections import OrderedDict
 from django.utils.functional import cached_property
+from django.utils import timezone
+from datetime import timedelta
 from copy import copy, deepcopy
 import json
-import dateutil
+import logging
+import dateutil.parser
 import time
 import django
 #from cbh_core_model.models import FlowFile
@@ -20,13 +24,34 @@ from django_hstore import hstore
 #FlowFile relocation stuff
 
 import os
+import hashlib
+from functools import partial
+import uuid
+from contextlib import contextmanager
 from django.db.models.signals import pre_delete
 from django.dispatch.dispatcher import receiver
+from django.dispatch import Signal
 from django.core.files.storage import default_storage
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
+from django.core.cache import cache
 from cbh_core_api.flowjs_settings import FLOWJS_PATH, FLOWJS_REMOVE_FILES_ON_DELETE, FLOWJS_AUTO_DELETE_CHUNKS
 from cbh_core_api.utils import chunk_upload_to
 from cbh_utils.idgenerator import IncrementalIdGenerator
+from cbh_core_model.tabular import infer_schema_from_file, extract_preview, can_preview
+from cbh_core_model.metrics import (measure, get_metrics_collector, CHUNK_WRITE, COUNTER_UPDATE, ASSEMBLY,
+    CHUNK_CLEANUP, UPLOAD)
+from cbh_core_model.uploads import (get_composer, preallocate_file, write_at_offset, copy_stream,
+    empty_bitmap, bitmap_has_chunk, set_bitmap_chunk, missing_bitmap_chunks, count_bitmap_chunks, get_assembly_backend,
+    move_to_content_store, delete_stored_files, upload_shard, open_local_mmap, zero_copy_slice,
+    default_compression, DecompressingFile, decompress_to_path, DetachedChunk, get_chunk_ingestor,
+    UploadBackpressure, pipeline_counters, FLOWJS_DEDUPLICATE_UPLOADS, FLOWJS_SHARDED_LAYOUT, FLOWJS_BUILD_PREVIEWS,
+    FLOWJS_PREVIEW_ROWS, FLOWJS_MAX_ACTIVE_UPLOADS, FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT, FLOWJS_MAX_ACTIVE_ASSEMBLIES,
+    FLOWJS_ACTIVE_UPLOAD_MINUTES, FLOWJS_ASSEMBLY_TIMEOUT_MINUTES, FLOWJS_DECOMPRESSED_DIR)
+
+
+logger = logging.getLogger(__name__)
 
 
 PERMISSION_CODENAME_SEPARATOR = "__"
@@ -103,6 +128,62 @@ class ProjectPermissionManager(models.Manager):
         for proj in self.all():
             proj.sync_permissions()
 
+    def bulk_provision(self, specs):
+        """
+        Create many projects in one transaction using set based inserts instead of saving each project and running its signals.
+        Each spec is a dictionary holding the name and created_by of a project and optionally its project_type, project_counter_start
+        and custom_field_config_template (a CustomFieldConfig or its id, by default the template of the project type).
+        Every project gets a custom field config with copies of the template fields, its viewer, editor and owner
+        permissions are created and the creator is made owner. Returns the created projects in the order of the specs
+        """
+        if not specs:
+            return []
+        with transaction.atomic():
+            projects = [self.model(name=spec["name"], project_key=slugify(spec["name"]), created_by=spec["created_by"], 
+                project_type=spec.get("project_type"), project_counter_start=spec.get("project_counter_start", 1)) for spec in specs]
+            self.bulk_create(projects)
+            #bulk_create does not set the primary keys so the projects are loaded again by their unique keys
+            saved = self.in_bulk_by_key([project.project_key for project in projects])
+            projects = [saved[project.project_key] for project in projects]
+
+            template_ids = []
+            for spec, project in zip(specs, projects):
+                template = spec.get("custom_field_config_template")
+                if template is None and project.project_type is not None:
+                    template = project.project_type.custom_field_config_template_id
+                template_ids.append(getattr(template, "pk", template))
+            #Templates that no longer exist are skipped, their projects get a config with no fields
+            templates = CustomFieldConfig.objects.get_templates([template_id for template_id in template_ids if template_id is not None])
+
+            #Configs are copied from their templates in the same way as clone_template copies them
+            configs = [copy_custom_field_config(templates.get(template_id, (None, []))[0], 
+                get_name_for_custom_field_config_from_project(project), project.created_by_id) 
+                for project, template_id in zip(projects, template_ids)]
+            CustomFieldConfig.objects.bulk_create(configs)
+            config_ids = dict(CustomFieldConfig.objects.filter(name__in=[config.name for config in configs]).values_list("name", "id"))
+            for project, config in zip(projects, configs):
+                project.custom_field_config_id = config.id = config_ids[config.name]
+            self.filter(pk__in=[project.pk for project in projects]).update(custom_field_config=Case(
+                *[When(pk=project.pk, then=Value(project.custom_field_config_id)) for project in projects], output_field=models.IntegerField()))
+            PinnedCustomField.objects.bulk_create([copy_pinned_custom_field(pcf, config.id) 
+                for config, template_id in zip(configs, template_ids) for pcf in templates.get(template_id, (None, []))[1]])
+
+            content_type = ContentType.objects.get_for_model(self.model)
+            Permission.objects.bulk_create([Permission(codename=get_permission_codename(project.id, perm[0]), 
+                name=get_permission_name(project.name, perm[0]), content_type=content_type) 
+                for project in projects for perm in PROJECT_PERMISSIONS])
+            owner_permission_ids = dict(Permission.objects.filter(content_type=content_type, 
+                codename__in=[get_permission_codename(project.id, "owner") for project in projects]).values_list("codename", "id"))
+            UserPermission = User.user_permissions.through
+            UserPermission.objects.bulk_create([UserPermission(user_id=project.created_by_id, 
+                permission_id=owner_permission_ids[get_permission_codename(project.id, "owner")]) for project in projects])
+        return projects
+
+    def in_bulk_by_key(self, project_keys):
+        """Load projects by their project keys in one query, returning a dictionary keyed on the project key"""
+        return dict((project.project_key, project) for project in 
+            self.filter(project_key__in=project_keys).select_related("project_type"))
+
 
 
     def get_next_incremental_id_for_compound(self, project_id):
@@ -269,27 +350,126 @@ class DataType(TimeStampedModel):
         return self.name
 
 
-class CustomFieldConfigManager(models.Manager):
+#Seconds a template custom field config and its fields are cached for. Saving or deleting a config or field drops it from the
+#cache and queryset updates change the cache version, but a per process cache such as LocMemCache is only cleared in the
+#process making the change, so with one of those the other processes can serve a stale template for up to this long
+CBH_TEMPLATE_CACHE_SECONDS = getattr(settings, "CBH_TEMPLATE_CACHE_SECONDS", 60)
+
+TEMPLATE_CACHE_VERSION_KEY = "cbh_core_model_template_version"
+
+
+def get_template_cache_version():
+    """The current version of the template cache, a new one is started when the key is missing"""
+    version = cache.get(TEMPLATE_CACHE_VERSION_KEY)
+    if version is None:
+        cache.add(TEMPLATE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(TEMPLATE_CACHE_VERSION_KEY)
+    return version
+
+
+def bump_template_cache_version():
+    """Make every cached template stale, for writes such as queryset updates that do not say which configs they change"""
+    cache.set(TEMPLATE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def get_template_cache_key(custom_field_config_id, version=None):
+    return "cbh_core_model_template_%s_%d" % (version or get_template_cache_version(), custom_field_config_id)
+
+
+class TemplateQuerySet(models.QuerySet):
+    """Bulk writes do not send the save signals, so they invalidate the cached templates themselves"""
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super(TemplateQuerySet, self).bulk_create(objs, *args, **kwargs)
+        config_ids = set(getattr(obj, "custom_field_config_id", None) for obj in objs) - set([None])
+        if config_ids:
+            version = get_template_cache_version()
+            cache.delete_many([get_template_cache_key(config_id, version) for config_id in config_ids])
+        return objs
+
+    def update(self, **kwargs):
+        """The rows changed are not known so every cached template is made stale"""
+        rows = super(TemplateQuerySet, self).update(**kwargs)
+        bump_template_cache_version()
+        return rows
+
+
+class CustomFieldConfigManager(models.Manager.from_queryset(TemplateQuerySet)):
     """Manage functions for custom field configs"""
+    def get_template(self, template_id):
+        """Return a (custom field config, list of pinned custom fields) pair for a template, cached by id"""
+        try:
+            return self.get_templates([template_id])[template_id]
+        except KeyError:
+            raise self.model.DoesNotExist("Custom field config %s does not exist" % template_id)
+
+    def get_templates(self, template_ids):
+        """
+        Return a dictionary of (custom field config, list of pinned custom fields) pairs keyed by template id.
+        Cached templates are fetched together and the rest are loaded with one query for all of their fields, plus one for
+        any configs without fields. Ids that do not match a custom field config are left out
+        """
+        version = get_template_cache_version()
+        keys = dict((get_template_cache_key(template_id, version), template_id) for template_id in set(template_ids))
+        templates = dict((keys[key], template) for key, template in cache.get_many(list(keys)).items())
+        missing = set(keys.values()) - set(templates)
+        if missing:
+            loaded = {}
+            for pcf in PinnedCustomField.objects.filter(custom_field_config_id__in=missing).select_related(
+                    "custom_field_config").order_by("position", "id"):
+                loaded.setdefault(pcf.custom_field_config_id, (pcf.custom_field_config, []))[1].append(pcf)
+            if missing - set(loaded):
+                for config in self.filter(pk__in=missing - set(loaded)):
+                    loaded[config.pk] = (config, [])
+            cache.set_many(dict((get_template_cache_key(template_id, version), template) 
+                for template_id, template in loaded.items()), CBH_TEMPLATE_CACHE_SECONDS)
+            templates.update(loaded)
+        return templates
+
+    def clone_template(self, template_id, name, creator):
+        """
+        Create a new custom field config from a template such as ProjectType.custom_field_config_template_id, all of
+        the fields of the template are copied into the new config with a single insert
+        """
+        template, fields = self.get_template(template_id)
+        with transaction.atomic():
+            custom_field_config = copy_custom_field_config(template, name, creator.pk)
+            custom_field_config.save()
+            PinnedCustomField.objects.bulk_create([copy_pinned_custom_field(pcf, custom_field_config.id) for pcf in fields])
+        return custom_field_config
+
     def from_schema_lists(self, data, names, data_types, widths, name, creator):
         '''
             Based on the lists of data and data types parsed from a single excel sheet or other tabular data...
             Generate a custom field config object
         '''
-        custom_field_config, created = self.get_or_create(
-                created_by=creator, name=name)
-        if  created:
-            for colindex, pandas_dtype in enumerate(data_types):
-                pcf = PinnedCustomField()
-                pcf.field_type = pcf.pandas_converter(
-                        widths[colindex], pandas_dtype)
-                pcf.name = names[colindex]
-                pcf.position = colindex
-                pcf.custom_field_config = custom_field_config
-                custom_field_config.pinned_custom_field.add(pcf)
-            custom_field_config.save()
+        with transaction.atomic():
+            custom_field_config, created = self.get_or_create(
+                    created_by=creator, name=name)
+            if  created:
+                #Build all of the fields first and insert them in a single query
+                pinned_fields = []
+                for colindex, pandas_dtype in enumerate(data_types):
+                    pcf = PinnedCustomField()
+                    pcf.field_type = pcf.pandas_converter(
+                            widths[colindex], pandas_dtype)
+                    pcf.name = names[colindex]
+                    pcf.position = colindex
+                    pcf.custom_field_config = custom_field_config
+                    pinned_fields.append(pcf)
+                PinnedCustomField.objects.bulk_create(pinned_fields)
         return custom_field_config
 
+    def from_schema_stream(self, source, name, creator, sample_size=None, extension=None):
+        '''
+            Read a CSV, TSV or Excel file (a path, file object or completed CBHFlowFile) as a stream of rows
+            inferring the type and width of each column without loading the sheet into memory, then
+            generate a custom field config object from the result.
+            If sample_size is given only that many data rows are read
+        '''
+        names, data_types, widths = infer_schema_from_file(
+                source, extension=extension, sample_size=sample_size)
+        return self.from_schema_lists(None, names, data_types, widths, name, creator)
+
 
 class CustomFieldConfig(TimeStampedModel):
     '''
@@ -309,6 +489,96 @@ class CustomFieldConfig(TimeStampedModel):
         return self.name.replace(u" ", u"__space__")
 
 
+DATA_FORM_LEVELS = ("l0_id", "l1_id", "l2_id", "l3_id", "l4_id")
+
+
+DATA_FORM_PATH_SEPARATOR = "/"
+
+
+def get_data_form_path(levels):
+    """
+    The materialized path of a data form config from its l0 to l4 ids, for example 12/7/33.
+    Every level up to the last one that is set has a segment, unset levels in between are left empty
+    so that 12 >> None >> 33 is stored as 12//33 and is not mistaken for 12 >> 33
+    """
+    levels = list(levels)
+    while levels and levels[-1] is None:
+        levels.pop()
+    return DATA_FORM_PATH_SEPARATOR.join("" if value is None else str(value) for value in levels)
+
+
+def get_ancestor_levels(levels):
+    """
+    For a tuple of the l0 to l4 ids of a data form config return the level tuples of its ancestors, nearest first.
+    Each ancestor keeps one less of the levels that are set, so the parent of l0 >> l1 >> l2 is l0 >> l1
+    """
+    used = [(index, value) for index, value in enumerate(levels) if value is not None][:-1]
+    ancestors = []
+    for count in range(len(used), 0, -1):
+        ancestor = [None] * len(DATA_FORM_LEVELS)
+        for index, value in used[:count]:
+            ancestor[index] = value
+        ancestors.append(tuple(ancestor))
+    return ancestors
+
+
+class DataFormConfigManager(models.Manager):
+    """Manager functions for data form configs"""
+    def filter_levels(self, level_tuples):
+        """All of the data form configs matching any of a list of l0 to l4 id tuples, in a single query"""
+        query = Q(pk__in=[])
+        for levels in level_tuples:
+            query |= Q(**dict(zip(DATA_FORM_LEVELS, levels)))
+        return self.filter(query)
+
+    def subtree(self, path, include_self=True):
+        """Data form configs at or below a materialized path, answered with a prefix lookup on the path index"""
+        descendants = Q(path__startswith=path + DATA_FORM_PATH_SEPARATOR)
+        return self.filter(descendants | Q(path=path) if include_self else descendants)
+
+    def build_tree(self, configs, creator, uri_stub=""):
+        """
+        Make sure that every ancestor of a list of data form configs exists and that each config points to its parent,
+        then return a new tree dictionary mapping "uri_stub/ancestor id" to the list of children of that ancestor
+        and "root" to the list of top level ancestors. Existing ancestors are loaded in one query, missing ones
+        are created with a single insert and the missing parent links are set with a single update
+        """
+        chains = [(config, get_ancestor_levels(tuple(getattr(config, level) for level in DATA_FORM_LEVELS))) for config in configs]
+        wanted = set(levels for config, ancestors in chains for levels in ancestors)
+        tree = {}
+        if not wanted:
+            return tree
+        with transaction.atomic():
+            by_levels = {}
+            #Order by id descending so that the oldest row wins if a level combination has been stored twice
+            for ancestor in self.filter_levels(wanted).order_by("-id"):
+                by_levels[tuple(getattr(ancestor, level) for level in DATA_FORM_LEVELS)] = ancestor
+            missing = wanted - set(by_levels)
+            if missing:
+                self.bulk_create([self.model(created_by_id=creator.id, human_added=False, path=get_data_form_path(levels), 
+                    **dict(zip(DATA_FORM_LEVELS, levels))) for levels in missing])
+                for ancestor in self.filter_levels(missing).order_by("-id"):
+                    by_levels[tuple(getattr(ancestor, level) for level in DATA_FORM_LEVELS)] = ancestor
+
+            parents = {}
+            for config, ancestors in chains:
+                child = config
+                for levels in ancestors:
+                    ancestor = by_levels[levels]
+                    if not child.parent_id:
+                        child.parent_id = parents[child.pk] = ancestor.pk
+                    children = tree.setdefault("%s/%d" % (uri_stub, ancestor.pk), [])
+                    if child not in children:
+                        children.append(child)
+                    child = ancestor
+                if ancestors and child not in tree.setdefault("root", []):
+                    tree["root"].append(child)
+            if parents:
+                self.filter(pk__in=list(parents)).update(parent=Case(
+                    *[When(pk=pk, then=Value(parent_id)) for pk, parent_id in parents.items()], output_field=models.IntegerField()))
+        return tree
+
+
 class DataFormConfig(TimeStampedModel):
 
     '''deprecated Shared configuration object - all projects can see this and potentially use it
@@ -343,6 +613,8 @@ class DataFormConfig(TimeStampedModel):
                            blank=True,
                            default=None,
                            help_text="The fifth level in the hierarchy of the form you are trying to create. For example, if curating industries, companies,  employees , teams and departments, l4 would be employees.")
+    path = models.CharField(max_length=100, db_index=True, blank=True, default="", 
+                            help_text="Materialized path of the l0 to l4 ids with empty segments for unset levels, for example 12/7/33 or 12//33, kept up to date on save")
 
     def __unicode__(self):
         string = ""
@@ -358,10 +630,40 @@ class DataFormConfig(TimeStampedModel):
             string += " >> " + self.l4.__unicode__()
         return string
 
+    objects = DataFormConfigManager()
+
     class Meta:
         unique_together = (('l0', 'l1', 'l2', 'l3', 'l4'),)
         ordering = ('l0', 'l1', 'l2', 'l3', 'l4')
 
+    def save(self, *args, **kwargs):
+        """Keep the materialized path in step with the levels"""
+        self.path = get_data_form_path(getattr(self, level) for level in DATA_FORM_LEVELS)
+        super(DataFormConfig, self).save(*args, **kwargs)
+
+    @property
+    def depth(self):
+        """Depth in the hierarchy counting from 0 for a config with only l0 set"""
+        return self.path.count(DATA_FORM_PATH_SEPARATOR) if self.path else -1
+
+    def get_descendants(self, include_self=False):
+        return DataFormConfig.objects.subtree(self.path, include_self=include_self)
+
+    def get_ancestors(self):
+        """Ancestors from the top level down, found by looking up each prefix of the path ending in a set level in one query"""
+        parts = self.path.split(DATA_FORM_PATH_SEPARATOR)
+        prefixes = [DATA_FORM_PATH_SEPARATOR.join(parts[:count]) for count in range(1, len(parts)) if parts[count - 1]]
+        return DataFormConfig.objects.filter(path__in=prefixes).order_by("path")
+
+    def get_descendants_at_depth(self, depth):
+        """Descendants whose last set level is at an absolute depth from 0 for l0 to 4 for l4"""
+        if not 0 <= depth < len(DATA_FORM_LEVELS):
+            raise ValueError("Depth must be between 0 and %d" % (len(DATA_FORM_LEVELS) - 1))
+        filters = {"%s__isnull" % DATA_FORM_LEVELS[depth]: False}
+        for level in DATA_FORM_LEVELS[depth + 1:]:
+            filters["%s__isnull" % level] = True
+        return self.get_descendants().filter(**filters)
+
     def last_level(self):
         last_level = ""
         if self.l4_id is not None:
@@ -376,42 +678,18 @@ class DataFormConfig(TimeStampedModel):
             return "l0"
         return last_level
 
-    def get_all_ancestor_objects(obj, request, tree_builder={}, uri_stub=""):
-        levels = ["l0", "l1", "l2", "l3", "l4"]
-        levels = ["%s_id" % l for l in levels]
-        used_levels = []
-        for lev in levels:
-            if getattr(obj, lev) is not None and lev != "%s_id" % obj.last_level():
-                used_levels.append(lev)
-
-        filters = []
-        for i in range(1, len(used_levels)+1):
-            level_name = used_levels[i-1]
-            level_filters = {lev: getattr(obj, lev) for lev in used_levels[:i]}
-            filters.insert(0, level_filters)
-
-        for index, filter_set in enumerate(filters):
-            defaults = {lev: None for lev in levels}
-            new_filters = defaults.update(filter_set)
-
-            defaults["defaults"] = {"created_by_id": request.user.id,
-                                    "human_added": False}
-            new_object, created = DataFormConfig.objects.get_or_create(
-                **defaults)
-            if not obj.parent_id:
-                obj.parent_id = new_object.id
-                obj.save()
-#
-
-            permitted_child_array = tree_builder.get(
-                "%s/%d" % (uri_stub, new_object.id), [])
-            permitted_child_array.append(obj)
-            tree_builder[
-                "%s/%d" % (uri_stub, new_object.id)] = list(set(permitted_child_array))
-
-            obj = new_object
-            if index == len(filters) - 1:
-                tree_builder["root"] = [obj]
+    def get_all_ancestor_objects(obj, request, tree_builder=None, uri_stub=""):
+        """Build the tree above this config with DataFormConfig.objects.build_tree, adding it to tree_builder if one is given"""
+        tree = DataFormConfig.objects.build_tree([obj], request.user, uri_stub=uri_stub)
+        if tree_builder is None:
+            return tree
+        for key, children in tree.items():
+            if key == "root":
+                tree_builder[key] = children
+            else:
+                existing = tree_builder.setdefault(key, [])
+                existing.extend(child for child in children if child not in existing)
+        return tree_builder
 
 
 class Project(TimeStampedModel, ProjectPermissionMixin):
@@ -519,15 +797,16 @@ def test_int(value):
         intval = int(value)
         if intval == floatval and "." not in unicode(value):
             return True
-    except  ValueError:
+    except (ValueError, TypeError):
         return False
+    return False
 
 def test_number(value):
     """Check if an input value is an number, not sure if this is used, possibly deprecated"""
     try:
         floatval = float(value)
         return True
-    except  ValueError:
+    except (ValueError, TypeError):
         return False
 
 
@@ -536,18 +815,53 @@ def test_stringdate(value):
     try:
         curated_value = dateutil.parser.parse(unicode(value)).strftime("%Y-%m-%d")
         return curated_value
-    except ValueError:
+    except (ValueError, TypeError, OverflowError):
         return False
 
 def test_percentage(value):
     """Check if an input value is an percentage, not sure if this is used, possibly deprecated"""
     result = test_number(value)
     if result:
-        if float(val) > 0 and float(val) < 100:
+        if float(value) > 0 and float(value) < 100:
             return True
     return False
 
 
+def validate_value(test_datatype, required, value):
+    """Apply a field type test function to a value, required fields must not be empty and empty values are
+    valid for optional fields"""
+    if not value and required:
+        return False
+    if value is None or value == "":
+        return True
+    return test_datatype(value)
+
+
+def invalidate_template_cache(sender, instance, **kwargs):
+    """Drop a custom field config from the template cache when it or one of its fields is saved or deleted"""
+    config_id = instance.pk if sender is CustomFieldConfig else instance.custom_field_config_id
+    if config_id is not None:
+        cache.delete(get_template_cache_key(config_id))
+
+
+post_save.connect(invalidate_template_cache, sender=CustomFieldConfig, dispatch_uid="template_cache1")
+post_delete.connect(invalidate_template_cache, sender=CustomFieldConfig, dispatch_uid="template_cache2")
+
+
+def copy_custom_field_config(template, name, created_by_id):
+    """An unsaved custom field config taking its schema form and data type from a template, which may be None"""
+    if template is None:
+        return CustomFieldConfig(name=name, created_by_id=created_by_id)
+    return CustomFieldConfig(name=name, created_by_id=created_by_id, schemaform=template.schemaform, 
+        data_type_id=template.data_type_id)
+
+
+def copy_pinned_custom_field(pcf, custom_field_config_id):
+    """An unsaved copy of a field belonging to another custom field config, ready for bulk_create"""
+    values = dict((field.attname, getattr(pcf, field.attname)) for field in pcf._meta.concrete_fields 
+        if not field.primary_key and field.attname not in ("created", "modified"))
+    values["custom_field_config_id"] = custom_field_config_id
+    return PinnedCustomField(**values)
 
 
 class PinnedCustomField(TimeStampedModel):
@@ -690,13 +1004,17 @@ class PinnedCustomField(TimeStampedModel):
         "self", related_name="attachment_field_mapped_from", blank=True, null=True, default=None,  help_text="deprecated")
     open_or_restricted = models.CharField(max_length=20, default=OPEN, choices=RESTRICTION_CHOICES,  help_text="Whether to open up this field to people who only have viewer rights on the project")
 
+    objects = TemplateQuerySet.as_manager()
+
     def validate_field(self, value):
         """Data type testing for fields in the custom fields of a compound batch (possibly deprecated or unfinished"""
-        if not value and self.required:
-            return False
-        else:
-            func = self.FIELD_TYPE_CHOICES[self.field_type]["test_datatype"]
-            return func(value)
+        func = self.FIELD_TYPE_CHOICES[self.field_type]["test_datatype"]
+        return validate_value(func, self.required, value)
+
+    @property
+    def validation_spec(self):
+        """A picklable (name, required, test function) tuple used when validating uploads away from the ORM"""
+        return (self.name, self.required, self.FIELD_TYPE_CHOICES[self.field_type]["test_datatype"])
 
 
     @cached_property
@@ -832,6 +1150,10 @@ class PinnedCustomField(TimeStampedModel):
         get_latest_by = 'created'
 
 
+post_save.connect(invalidate_template_cache, sender=PinnedCustomField, dispatch_uid="template_cache3")
+post_delete.connect(invalidate_template_cache, sender=PinnedCustomField, dispatch_uid="template_cache4")
+
+
 class Invitation(TimeStampedModel):
     """Invitation model which saves the fact that an invitation has been sent to a given user"""
     email = models.CharField(max_length=100)
@@ -846,6 +1168,145 @@ class Invitation(TimeStampedModel):
 
 
 
+def raw_delete(model, column, values):
+    """Delete rows with a single query that bypasses the per object delete signals, used when the files
+    belonging to the rows have already been dealt with in bulk"""
+    if not values:
+        return 0
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(column), ", ".join(["%s"] * len(values))), list(values))
+    return cursor.rowcount
+
+
+def stored_file_size(storage, name):
+    """Size of a stored file or 0 if it does not exist"""
+    try:
+        return storage.size(name)
+    except (OSError, IOError):
+        return 0
+
+
+class CBHFlowFileManager(models.Manager):
+    """Manager functions for flow files"""
+    def active_uploads(self):
+        """Uploads still receiving chunks which were started recently enough to count against the concurrency limits"""
+        return self.filter(state=CBHFlowFile.STATE_UPLOADING,
+            created__gte=timezone.now() - timedelta(minutes=FLOWJS_ACTIVE_UPLOAD_MINUTES))
+
+    def active_assemblies(self):
+        """Uploads being assembled whose assembly job started within the assembly timeout"""
+        return self.filter(state=CBHFlowFile.STATE_ASSEMBLING,
+            assembly_started__gte=timezone.now() - timedelta(minutes=FLOWJS_ASSEMBLY_TIMEOUT_MINUTES))
+
+    def stuck_assemblies(self, timeout=None):
+        """
+        Uploads that have been assembling for longer than timeout (a timedelta, by default the assembly timeout),
+        their assembly job was most likely lost when the process running it was restarted or crashed
+        """
+        cutoff = timezone.now() - (timeout or timedelta(minutes=FLOWJS_ASSEMBLY_TIMEOUT_MINUTES))
+        return self.filter(Q(assembly_started__lt=cutoff) | Q(assembly_started__isnull=True, created__lt=cutoff),
+            state=CBHFlowFile.STATE_ASSEMBLING)
+
+    def recover_assemblies(self, timeout=None, requeue=True, backend=None):
+        """
+        Queue the assembly of stuck uploads again, or mark them as failed when requeue is not set.
+        Each upload is claimed with a conditional update so that it is only recovered once when several processes
+        run this at the same time. Returns the number of uploads recovered
+        """
+        recovered = 0
+        backend = backend or get_assembly_backend()
+        for pk in list(self.stuck_assemblies(timeout).values_list("pk", flat=True)):
+            if requeue:
+                claimed = self.stuck_assemblies(timeout).filter(pk=pk).update(assembly_started=timezone.now())
+                if claimed:
+                    backend.submit(assemble_flow_file, pk)
+            else:
+                claimed = self.stuck_assemblies(timeout).filter(pk=pk).update(state=CBHFlowFile.STATE_UPLOAD_ERROR)
+            recovered += claimed
+        return recovered
+
+    def check_capacity(self, project_id):
+        """
+        Raise UploadBackpressure if starting another upload in the project would go over the configured limits on
+        uploads in progress, per project and across the system, or if too many uploads are being assembled.
+        The limits are checked with counts before the upload is created so concurrent requests may overshoot slightly
+        """
+        if FLOWJS_MAX_ACTIVE_ASSEMBLIES is not None and self.active_assemblies().count() >= FLOWJS_MAX_ACTIVE_ASSEMBLIES:
+            pipeline_counters.reject("assemblies")
+            raise UploadBackpressure("Too many uploads are being assembled, please try again later")
+        if FLOWJS_MAX_ACTIVE_UPLOADS is not None and self.active_uploads().count() >= FLOWJS_MAX_ACTIVE_UPLOADS:
+            pipeline_counters.reject("uploads")
+            raise UploadBackpressure("Too many uploads are in progress, please try again later")
+        if FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT is not None and \
+                self.active_uploads().filter(project_id=project_id).count() >= FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT:
+            pipeline_counters.reject("project_uploads")
+            raise UploadBackpressure("Too many uploads are in progress in this project, please try again later")
+
+    def pipeline_stats(self):
+        """Numbers of uploads in progress and being assembled, the assembly queue depth and wait times and
+        how many uploads this process has turned away, for tuning the concurrency limits"""
+        stats = {
+            "active_uploads": self.active_uploads().count(),
+            "active_uploads_by_project": dict(self.active_uploads().values_list("project_id").annotate(count=models.Count("id"))),
+            "assembling": self.active_assemblies().count(),
+            "stuck_assemblies": self.stuck_assemblies().count(),
+            "assembly_backend": get_assembly_backend().stats(),
+        }
+        stats.update(pipeline_counters.stats())
+        return stats
+
+    def collect_stale(self, max_age, batch_size=500, dry_run=False):
+        """
+        Delete uploads that are still uploading, that failed or whose assembly has been stuck for longer than max_age
+        (a timedelta) and were created longer than max_age ago, along with their chunk files. Uploads are streamed in batches
+        of ids, the chunk rows of each batch are deleted with a single query and the uploads with a cascading delete so that
+        previews and rows in other apps pointing at them go too. Files are only removed once the rows are gone, after the
+        transaction commits. Returns the number of uploads removed and the number of bytes reclaimed,
+        when dry_run is set nothing is deleted and the figures say what would have been removed
+        """
+        stale = self.filter(Q(state__in=[CBHFlowFile.STATE_UPLOADING, CBHFlowFile.STATE_UPLOAD_ERROR]) | 
+            Q(pk__in=self.stuck_assemblies(max_age).values("pk")), created__lt=timezone.now() - max_age)
+        removed = 0
+        reclaimed = 0
+        last_id = 0
+        while True:
+            ids = list(stale.filter(pk__gt=last_id).order_by("pk").values_list("pk", flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            with transaction.atomic():
+                # lock the batch and read it again, an upload may have completed since the ids were read
+                batch = list(stale.select_for_update().filter(pk__in=ids).order_by("pk"))
+                ids = [flow_file.pk for flow_file in batch]
+                names = list(CBHFlowFileChunk.objects.filter(parent_id__in=ids).values_list("file", flat=True))
+                # partially written or assembled target files, which the pre_delete receiver removes when that is turned on.
+                # Files in the content store may be shared with other uploads so they are only ever left to that receiver
+                targets = [flow_file.path for flow_file in batch 
+                    if not flow_file.storage_path and default_storage.exists(flow_file.path)]
+                reclaimed += sum(stored_file_size(default_storage, name) for name in names + targets)
+                if not dry_run:
+                    if not FLOWJS_REMOVE_FILES_ON_DELETE:
+                        names += targets
+                    directories = [flow_file.chunk_directory for flow_file in batch if flow_file.sharded_layout]
+                    raw_delete(CBHFlowFileChunk, "parent_id", ids)
+                    self.filter(pk__in=ids).delete()
+                    transaction.on_commit(partial(remove_stale_files, names, directories))
+            removed += len(batch)
+        return removed, reclaimed
+
+
+def remove_stale_files(names, directories):
+    """Remove the files of collected uploads and their now empty per upload chunk directories"""
+    delete_stored_files(default_storage, names)
+    for directory in directories:
+        delete_stored_files(default_storage, [], directory=directory)
+
+
+#Sent with the upload as the instance once it has been assembled and marked as completed
+flow_file_completed = Signal(providing_args=["instance"])
+
+
 class CBHFlowFile(models.Model):
     """
     A file upload through Flow.js
@@ -853,11 +1314,13 @@ class CBHFlowFile(models.Model):
     STATE_UPLOADING = 1
     STATE_COMPLETED = 2
     STATE_UPLOAD_ERROR = 3
+    STATE_ASSEMBLING = 4
 
     STATE_CHOICES = [
         (STATE_UPLOADING, "Uploading"),
         (STATE_COMPLETED, "Completed"),
-        (STATE_UPLOAD_ERROR, "Upload Error")
+        (STATE_UPLOAD_ERROR, "Upload Error"),
+        (STATE_ASSEMBLING, "Assembling"),
     ]
 
     # identification and file details
@@ -873,15 +1336,175 @@ class CBHFlowFile(models.Model):
     updated = models.DateField(auto_now=True, help_text="Date the upload was updated")
     project = models.ForeignKey("cbh_core_model.Project", help_text="Project that the uploaded file is associated with")
 
+    # writing chunks straight into the target file
+    write_in_place = models.BooleanField(default=False, help_text="Whether chunks are written straight to their offset in a preallocated file instead of being stored separately and joined")
+    chunk_size = models.IntegerField(default=0, help_text="Size in bytes of every chunk apart from the last, used to calculate where each chunk is written")
+    received_chunks = models.BinaryField(default=b"", help_text="Bitmap of the chunk numbers received so far")
+    assembly_started = models.DateTimeField(null=True, blank=True, default=None, help_text="Date the current assembly job was queued, used to find assemblies that were lost")
+    sharded_layout = models.BooleanField(default=False, help_text="Whether the files of this upload are in the sharded directory layout, taken from FLOWJS_SHARDED_LAYOUT when the upload is created")
+
+    # content deduplication
+    sha256 = models.CharField(max_length=64, db_index=True, null=True, blank=True, default=None, help_text="SHA-256 digest of the assembled file")
+    storage_path = models.CharField(max_length=500, null=True, blank=True, default=None, help_text="Path the assembled content is stored at, uploads with identical content share the same path")
+
+    # compression at rest
+    compression = models.CharField(max_length=10, blank=True, default="", help_text="Compression applied to the stored file, gzip, zstd or blank for none")
+    compressed_size = models.BigIntegerField(null=True, blank=True, default=None, help_text="Size in bytes of the stored file when compressed")
+
+    objects = CBHFlowFileManager()
+
+    class Meta:
+        index_together = [["state", "created"]]
+
     def __unicode__(self):
         """Unicode representation of the file"""
         return self.identifier
 
-    def update(self):
-        """Check the status of the uploading chunks"""
-        self.total_chunks_uploaded = self.chunks.count()
-        super(CBHFlowFile, self).save()
-        self.join_chunks()
+    def save(self, *args, **kwargs):
+        """Start with an empty received chunks bitmap and when writing in place, allocate the full size of the target file before any chunks arrive"""
+        if self._state.adding:
+            if self.write_in_place and self.total_chunks > 1 and self.chunk_size <= 0:
+                raise ValueError("A chunk size is needed to work out where each chunk of %s is written" % self.identifier)
+            CBHFlowFile.objects.check_capacity(self.project_id)
+            self.received_chunks = bytes(empty_bitmap(self.total_chunks))
+            # the layout is kept with the upload so that changing the setting does not lose track of its files
+            self.sharded_layout = FLOWJS_SHARDED_LAYOUT
+            if self.write_in_place:
+                preallocate_file(default_storage.path(self.path), self.total_size)
+        super(CBHFlowFile, self).save(*args, **kwargs)
+
+    def write_chunk(self, number, data):
+        """
+        Write a chunk (a file object or byte string) straight to its offset in the target file and
+        mark it as received, the upload is completed once every chunk has been written
+        """
+        if not 1 <= number <= self.total_chunks:
+            raise ValueError("Chunk %d is outside of the %d chunks of the upload" % (number, self.total_chunks))
+        with measure(CHUNK_WRITE, self) as measurement:
+            measurement["bytes"] = write_at_offset(default_storage.path(self.path), data, (number - 1) * self.chunk_size)
+        with measure(COUNTER_UPDATE, self):
+            self.total_chunks_uploaded = self.mark_chunk_received(number)
+        if self.total_chunks_uploaded == self.total_chunks:
+            self.start_assembly()
+
+    def receive_chunk(self, number, data):
+        """Store a chunk (a file object or byte string) and record its arrival, returning the new count of uploaded chunks"""
+        if self.write_in_place:
+            self.write_chunk(number, data)
+        else:
+            chunk = CBHFlowFileChunk(parent=self, number=number)
+            chunk.file = data if hasattr(data, "chunks") else ContentFile(data, name=self.get_chunk_filename(number))
+            chunk.save()
+        return self.total_chunks_uploaded
+
+    def ingest_chunk(self, number, data, wait=True):
+        """
+        Write a chunk on the chunk ingestion pool, which bounds the number of chunk writes running at once.
+        By default this waits for the chunk to be stored and recorded, returning the new count of uploaded chunks and
+        raising any error from the write, so that the response to Flow.js is only sent once the chunk is safe.
+        There is no timeout, a write that is given up on carries on in the pool and the chunk sent again by Flow.js
+        would race with it, so when the pool is busy chunks are turned away before they are submitted instead.
+
+        With wait=False a PendingChunk is returned straight away. It is not safe to acknowledge the chunk before
+        PendingChunk.wait() has returned, a failed write or a restart of the process would lose the chunk without
+        Flow.js knowing and the upload would never complete
+        """
+        chunk = DetachedChunk(data)
+        try:
+            pending = get_chunk_ingestor().submit(ingest_flow_file_chunk, self.pk, number, chunk)
+        except UploadBackpressure:
+            chunk.discard()
+            raise
+        if not wait:
+            return pending
+        self.total_chunks_uploaded = pending.wait()
+        return self.total_chunks_uploaded
+
+    def mark_chunk_received(self, number):
+        """Atomically set the bit for a chunk in the received chunks bitmap, the uploaded chunk count
+        is only increased the first time a chunk number is seen. Returns the new count"""
+        if not 1 <= number <= self.total_chunks:
+            raise ValueError("Chunk %d is outside of the %d chunks of the upload" % (number, self.total_chunks))
+        self.seed_bitmap()
+        bit = number - 1
+        if connection.vendor == "postgresql":
+            cursor = connection.cursor()
+            cursor.execute("UPDATE %s SET "
+                "total_chunks_uploaded = total_chunks_uploaded + 1 - get_bit(received_chunks, %%s), "
+                "received_chunks = set_bit(received_chunks, %%s, 1) "
+                "WHERE id = %%s RETURNING total_chunks_uploaded" % connection.ops.quote_name(self._meta.db_table), 
+                [bit, bit, self.pk])
+            return cursor.fetchone()[0]
+        with transaction.atomic():
+            bitmap, count = CBHFlowFile.objects.select_for_update().filter(pk=self.pk).values_list("received_chunks", "total_chunks_uploaded")[0]
+            if not bitmap_has_chunk(bitmap, number):
+                count += 1
+                CBHFlowFile.objects.filter(pk=self.pk).update(received_chunks=bytes(set_bitmap_chunk(bitmap, number)), total_chunks_uploaded=count)
+            return count
+
+    def seed_bitmap(self):
+        """
+        Uploads started before the received chunks bitmap existed have an empty one, build it from their chunk rows and
+        reset the count to the number of distinct chunks so that chunks which are sent again are not counted twice.
+        The bitmap is only replaced while it is still empty so concurrent requests seed it once
+        """
+        if len(self.received_chunks or b"") or self.total_chunks <= 0:
+            return
+        bitmap = empty_bitmap(self.total_chunks)
+        for number in set(self.chunks.values_list("number", flat=True)):
+            if 1 <= number <= self.total_chunks:
+                bitmap = set_bitmap_chunk(bitmap, number)
+        CBHFlowFile.objects.filter(pk=self.pk, received_chunks=b"").update(received_chunks=bytes(bitmap), 
+            total_chunks_uploaded=count_bitmap_chunks(bitmap))
+        self.received_chunks, self.total_chunks_uploaded = CBHFlowFile.objects.filter(pk=self.pk).values_list(
+            "received_chunks", "total_chunks_uploaded")[0]
+
+    def has_chunk(self, number):
+        """Whether a chunk has been received, answered from the bitmap loaded with the upload so no query is needed per chunk"""
+        return bitmap_has_chunk(self.received_chunks, number)
+
+    def missing_chunks(self):
+        """Reload the received chunks bitmap and return the numbers of all of the chunks not yet received, for resuming an upload in one call"""
+        self.received_chunks = CBHFlowFile.objects.filter(pk=self.pk).values_list("received_chunks", flat=True)[0]
+        self.seed_bitmap()
+        return missing_bitmap_chunks(self.received_chunks, self.total_chunks)
+
+    def update(self, number):
+        """Record the arrival of a chunk and queue the joining of the chunks once they have all been uploaded"""
+        with measure(COUNTER_UPDATE, self):
+            self.total_chunks_uploaded = self.mark_chunk_received(number)
+        if self.total_chunks_uploaded == self.total_chunks and not self.write_in_place:
+            self.start_assembly()
+
+    def claim_completion(self, new_state):
+        """
+        Move the upload out of the uploading state with a conditional update that only matches when every chunk
+        has been counted, when chunks finish at the same time on different workers exactly one of them gets True
+        """
+        changes = {"state": new_state}
+        if new_state == self.STATE_ASSEMBLING:
+            changes["assembly_started"] = timezone.now()
+        claimed = CBHFlowFile.objects.filter(pk=self.pk, state=self.STATE_UPLOADING, 
+            total_chunks_uploaded=F("total_chunks")).update(**changes)
+        if claimed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+        return bool(claimed)
+
+    def start_assembly(self):
+        """Claim the upload for assembly and hand the join over to the assembly backend once the current transaction commits"""
+        if self.claim_completion(self.STATE_ASSEMBLING):
+            pk = self.pk
+            transaction.on_commit(lambda: get_assembly_backend().submit(assemble_flow_file, pk))
+
+    def poll_state(self):
+        """Reload the state of the upload from the database, used by clients waiting for the file to be assembled"""
+        self.state = CBHFlowFile.objects.filter(pk=self.pk).values_list("state", flat=True)[0]
+        return self.state
+
+    @property
+    def is_assembling(self):
+        return self.state == self.STATE_ASSEMBLING
 
     @property
     def extension(self):
@@ -904,23 +1527,147 @@ class CBHFlowFile(models.Model):
         Return the uploaded file
         """
         if self.state == self.STATE_COMPLETED:
-            return default_storage.open(self.path)
+            stored = default_storage.open(self.path)
+            if self.compression:
+                return DecompressingFile(stored, self.compression, size=self.total_size or None, name=self.filename)
+            return stored
         return None
 
+    def open_mmap(self):
+        """
+        Return a read only memory map of a completed upload on local storage, the caller is responsible for closing it.
+        Raises NotImplementedError when the storage is not on the local filesystem
+        """
+        if self.state != self.STATE_COMPLETED:
+            raise ValueError("The upload has not completed")
+        if self.compression:
+            raise ValueError("Compressed uploads cannot be memory mapped")
+        return open_local_mmap(default_storage.path(self.path))
+
+    @property
+    def can_mmap(self):
+        """Whether the upload is stored uncompressed on local storage, so that it can be memory mapped"""
+        return not self.compression and get_composer(default_storage).has_local_paths
+
+    def read_range(self, offset, length):
+        """
+        Return up to length bytes starting at offset of a completed upload, fewer when the range runs past the end
+        of the file. Uploads that can be memory mapped are read through a map that is closed again before returning
+        """
+        if self.state != self.STATE_COMPLETED:
+            raise ValueError("The upload has not completed")
+        if offset < 0 or length < 0:
+            raise ValueError("The offset and length of a range cannot be negative")
+        if self.total_size == 0:
+            return b""
+        if not self.can_mmap:
+            with self.file as stored:
+                stored.seek(offset)
+                return stored.read(length)
+        mapped = self.open_mmap()
+        try:
+            return mapped[offset:offset + length]
+        finally:
+            mapped.close()
+
+    @contextmanager
+    def mapped_range(self, offset, length):
+        """
+        A zero copy view of up to length bytes starting at offset of an upload that can be memory mapped, the view
+        is only valid inside the with block as the map is closed on leaving it
+        """
+        if not self.can_mmap:
+            raise ValueError("%s cannot be memory mapped, use read_range" % self.identifier)
+        if self.total_size == 0:
+            yield b""
+            return
+        mapped = self.open_mmap()
+        view = zero_copy_slice(mapped, offset, length)
+        try:
+            yield view
+        finally:
+            #a map with views still exported cannot be closed
+            if hasattr(view, "release"):
+                view.release()
+            del view
+            mapped.close()
+
     @property
     def full_path(self):
         """
-        Return the full path of the file uploaded
+        Return the full path of the file uploaded, compressed uploads are decompressed to a local copy the first time
+        their path is asked for, which is removed along with the upload
         """
+        if self.compression:
+            if not os.path.exists(self.decompressed_path):
+                with self.file as stored:
+                    decompress_to_path(stored, self.decompressed_path)
+            return self.decompressed_path
         return os.path.join(settings.MEDIA_ROOT, self.path)
 
+    @property
+    def decompressed_path(self):
+        """
+        Return the path of the local decompressed copy of a compressed upload, named after the primary key as well
+        as the identifier so that a later upload reusing the identifier cannot be given a stale copy
+        """
+        return os.path.join(FLOWJS_DECOMPRESSED_DIR, "%s-%s" % (self.pk, self.filename))
+
     @property
     def path(self):
         """
         Return the path of the file uploaded
         """
+        if self.storage_path:
+            return self.storage_path
+        return self.get_layout_path(self.sharded_layout)
+
+    def get_layout_path(self, sharded):
+        """
+        Return the path the assembled file is written to in either the flat or the sharded directory layout
+        """
+        if sharded:
+            return os.path.join(FLOWJS_PATH, upload_shard(self.identifier), self.filename)
         return os.path.join(FLOWJS_PATH, self.filename)
 
+    @property
+    def chunk_directory(self):
+        """
+        Return the directory holding only the chunks of this upload in the sharded layout
+        """
+        return os.path.join(FLOWJS_PATH, "chunks", upload_shard(self.identifier), self.identifier)
+
+    @property
+    def content_path(self):
+        """
+        Return the content addressed path of the file, based on the SHA-256 digest
+        """
+        suffix = ".%s" % self.compression if self.compression else ""
+        return os.path.join(FLOWJS_PATH, "content", self.sha256[:2], "%s%s%s" % (self.sha256, self.extension, suffix))
+
+    def store_content(self, digest):
+        """
+        Record the digest of the assembled file and move it to its content addressed path,
+        if the same content has already been uploaded this upload shares the stored copy.
+        The uploads with the same digest are locked, as they are by flow_file_delete, so that the last other
+        upload referring to the stored copy cannot be deleted, removing the copy, while this upload is joining it
+        """
+        self.sha256 = digest
+        with transaction.atomic():
+            sharing = CBHFlowFile.objects.select_for_update().filter(sha256=digest).exclude(pk=self.pk)
+            shared = self.content_path in set(sharing.values_list("storage_path", flat=True))
+            self.storage_path = move_to_content_store(default_storage, self.path, self.content_path, shared)
+            # save the reference before the lock is released
+            CBHFlowFile.objects.filter(pk=self.pk).update(sha256=self.sha256, storage_path=self.storage_path)
+
+    def duplicates(self):
+        """
+        Other completed uploads with identical content, parsers can reuse work already done on them
+        """
+        if not self.sha256:
+            return CBHFlowFile.objects.none()
+        return CBHFlowFile.objects.filter(sha256=self.sha256, state=self.STATE_COMPLETED).exclude(pk=self.pk)
+
     def get_chunk_filename(self, number):
         """
         Return the filename of the chunk based on the identifier and chunk number
@@ -931,22 +1678,61 @@ class CBHFlowFile(models.Model):
         """
         Join all the chunks in one file
         """
-        if self.state == self.STATE_UPLOADING and self.total_chunks_uploaded == self.total_chunks:
-
-            # create file and write chunks in the right order
-            temp_file = open(self.full_path, "wb")
-            for chunk in self.chunks.all():
-                chunk_bytes = chunk.file.read()
-                temp_file.write(chunk_bytes)
-            temp_file.close()
-
-            # set state as completed
-            self.state = self.STATE_COMPLETED
-            super(CBHFlowFile, self).save()
+        if self.state == self.STATE_ASSEMBLING:
+            with measure(ASSEMBLY, self, self.total_size):
+                self._assemble()
+            get_metrics_collector().record(UPLOAD, (timezone.now() - self.created).total_seconds(), self.total_size,
+                upload_id=self.pk, project_id=self.project_id)
 
             # delete chunks automatically if is activated in settings
             if FLOWJS_AUTO_DELETE_CHUNKS:
-                self.chunks.all().delete()
+                self.delete_chunks()
+
+            flow_file_completed.send(sender=CBHFlowFile, instance=self)
+
+    def _assemble(self):
+        """Compose, hash and store the assembled file then mark the upload as completed"""
+        composer = get_composer(default_storage)
+        # uploads are only hashed when they can be moved into the content store, which needs local paths
+        digest = hashlib.sha256() if FLOWJS_DEDUPLICATE_UPLOADS and composer.has_local_paths else None
+        try:
+            if not self.write_in_place:
+                # join the chunks in the right order, compressing them if activated in settings
+                self.compression = "" if composer.composes_remotely else default_compression(self.extension)
+                # a chunk sent again has more than one row, only the last row saved for each number is joined
+                sources = list(OrderedDict(self.chunks.order_by("number", "pk").values_list("number", "file")).values())
+                stored_size = composer.compose(sources, self.path, digest=digest, compression=self.compression)
+                if self.compression:
+                    self.compressed_size = stored_size
+            elif digest is not None:
+                # chunks were written in place so the file only needs hashing
+                with default_storage.open(self.path) as assembled:
+                    copy_stream(assembled, None, digest=digest)
+            if digest is not None:
+                self.store_content(digest.hexdigest())
+        except Exception:
+            CBHFlowFile.objects.filter(pk=self.pk).update(state=self.STATE_UPLOAD_ERROR)
+            self.state = self.STATE_UPLOAD_ERROR
+            raise
+
+        # set state as completed without overwriting the rest of the row
+        CBHFlowFile.objects.filter(pk=self.pk, state=self.STATE_ASSEMBLING).update(
+            state=self.STATE_COMPLETED, sha256=self.sha256, storage_path=self.storage_path,
+            compression=self.compression, compressed_size=self.compressed_size)
+        self.state = self.STATE_COMPLETED
+
+    def delete_chunks(self):
+        """
+        Remove the files of all of the chunks in one pass and then the chunk rows with a single query,
+        rather than firing the pre_delete signal and deleting each file separately
+        """
+        with measure(CHUNK_CLEANUP, self):
+            names = list(self.chunks.values_list("file", flat=True))
+            directory = None
+            if names and all(os.path.dirname(name) == self.chunk_directory for name in names):
+                directory = self.chunk_directory
+            delete_stored_files(default_storage, names, directory=directory)
+            raw_delete(CBHFlowFileChunk, "parent_id", [self.pk])
 
     def is_valid_session(self, session):
         """
@@ -955,6 +1741,83 @@ class CBHFlowFile(models.Model):
         return self.identifier.startswith(session)
 
 
+def flow_chunk_upload_to(instance, filename):
+    """Upload location of a chunk, in the sharded layout each upload gets a directory of its own"""
+    if instance.parent.sharded_layout:
+        return os.path.join(instance.parent.chunk_directory, instance.filename)
+    return chunk_upload_to(instance, filename)
+
+
+class CBHFlowFilePreviewManager(models.Manager):
+    """Manager functions for upload previews"""
+    def build_for(self, flow_file, max_rows=FLOWJS_PREVIEW_ROWS):
+        """Read the start of a completed upload and store its type, headers, first rows and estimated row count"""
+        with flow_file.file as stored:
+            preview = extract_preview(stored, flow_file.extension, flow_file.total_size, max_rows=max_rows)
+        obj, created = self.update_or_create(flow_file=flow_file, defaults={
+            "file_type": preview["file_type"],
+            "headers": json.dumps(preview["headers"]),
+            "rows": json.dumps(preview["rows"]),
+            "estimated_row_count": preview["estimated_row_count"],
+        })
+        return obj
+
+
+class CBHFlowFilePreview(models.Model):
+    """
+    The headers and first rows of a completed upload, extracted once so that they can be shown without re-parsing the file
+    """
+    flow_file = models.OneToOneField(CBHFlowFile, related_name="preview", help_text="The upload this preview was taken from")
+    file_type = models.CharField(max_length=10, help_text="Type of file sniffed from the start of the upload, csv, tsv, sdf or xlsx")
+    headers = models.TextField(default="[]", help_text="JSON list of the column headers, or the data tags of an SD file")
+    rows = models.TextField(default="[]", help_text="JSON list of the first rows of the file")
+    estimated_row_count = models.IntegerField(default=0, help_text="Number of rows or records in the file, estimated from the start of the file when it is large")
+    created = models.DateTimeField(auto_now_add=True, help_text="Date the preview was extracted")
+
+    objects = CBHFlowFilePreviewManager()
+
+    def __unicode__(self):
+        return self.flow_file.identifier
+
+    @cached_property
+    def header_list(self):
+        return json.loads(self.headers)
+
+    @cached_property
+    def row_list(self):
+        return json.loads(self.rows)
+
+
+def build_flow_file_preview(sender, instance, **kwargs):
+    """
+    Extract a preview from each tabular upload as it completes if activated in settings. The upload has already been
+    completed so a file that cannot be read as a table is logged rather than failing the request or assembly job
+    """
+    if FLOWJS_BUILD_PREVIEWS and can_preview(instance.extension):
+        try:
+            CBHFlowFilePreview.objects.build_for(instance)
+        except Exception:
+            logger.exception("Could not extract a preview from upload %s", instance.identifier)
+
+
+flow_file_completed.connect(build_flow_file_preview, sender=CBHFlowFile, dispatch_uid="flow_preview")
+
+
+def assemble_flow_file(flow_file_id):
+    """Assembly job run by the assembly backend"""
+    CBHFlowFile.objects.get(pk=flow_file_id).join_chunks()
+
+
+def ingest_flow_file_chunk(flow_file_id, number, chunk):
+    """Chunk ingestion job run by the chunk ingestion pool"""
+    try:
+        flow_file = CBHFlowFile.objects.get(pk=flow_file_id)
+        with chunk.open(flow_file.get_chunk_filename(number)) as data:
+            return flow_file.receive_chunk(number, data)
+    finally:
+        chunk.discard()
+
+
 class CBHFlowFileChunk(models.Model):
     """
     A chunk is part of the file uploaded
@@ -964,7 +1827,7 @@ class CBHFlowFileChunk(models.Model):
 
     # identification and file details
     parent = models.ForeignKey(CBHFlowFile, related_name="chunks", )
-    file = models.FileField(max_length=255, upload_to=chunk_upload_to)
+    file = models.FileField(max_length=255, upload_to=flow_chunk_upload_to)
     number = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -976,8 +1839,18 @@ class CBHFlowFileChunk(models.Model):
         return self.parent.get_chunk_filename(self.number)
 
     def save(self, *args, **kwargs):
+        #Only count the chunk the first time it is saved
+        adding = self._state.adding
+        if not adding:
+            return super(CBHFlowFileChunk, self).save(*args, **kwargs)
+        #Write the chunk file to storage here rather than leaving it to the field as the row is saved,
+        #so that only the storage write is timed and the size is taken from the content without asking the storage
+        if self.file and not self.file._committed:
+            content = self.file.file
+            with measure(CHUNK_WRITE, self.parent, getattr(content, "size", None) or 0):
+                self.file.save(self.filename, content, save=False)
         super(CBHFlowFileChunk, self).save(*args, **kwargs)
-        self.parent.update()
+        self.parent.update(self.number)
 
 
 @receiver(pre_delete, sender=CBHFlowFile)
@@ -985,31 +1858,157 @@ def flow_file_delete(sender, instance, **kwargs):
     """
     Remove files on delete if is activated in settings
     """
+    if instance.compression:
+        # the decompressed copy is only a cache so it goes whatever the settings
+        transaction.on_commit(partial(remove_local_file, instance.decompressed_path))
     if FLOWJS_REMOVE_FILES_ON_DELETE:
-        try:
-            default_storage.delete(instance.path)
-        except NotImplementedError:
-            pass
+        # content shared with other uploads is only removed along with the last upload referring to it,
+        # the uploads with the same digest are locked so that a new upload cannot join the content meanwhile
+        if instance.storage_path and instance.sha256:
+            sharing = CBHFlowFile.objects.select_for_update().filter(sha256=instance.sha256).exclude(pk=instance.pk)
+            if instance.storage_path in set(sharing.values_list("storage_path", flat=True)):
+                return
+            # removed while the lock is held, once it is released a new upload can store the same content again
+            delete_flow_file_path(instance.path)
+            return
+        # other files are only removed once the delete has been committed
+        transaction.on_commit(partial(delete_flow_file_path, instance.path))
+
+
+def remove_local_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def delete_flow_file_path(name):
+    try:
+        default_storage.delete(name)
+    except NotImplementedError:
+        pass
 
 
 @receiver(pre_delete, sender=CBHFlowFileChunk)
 def flow_file_chunk_delete(sender, instance, **kwargs):
     """
-    Remove file when chunk is deleted
+    Remove file when chunk is deleted, once the delete has been committed
     """
-    instance.file.delete(False)
+    if instance.file.name:
+        transaction.on_commit(partial(instance.file.storage.delete, instance.file.name))
 
 
+#Record field level changes to projects and custom field configs in ChangeLogEntry, no receivers are connected when off
+CBH_CHANGE_LOG = getattr(settings, "CBH_CHANGE_LOG", False)
 
-def print_name(sender, instance, **kwargs):
-    instance.project_key = slugify(instance.name)
 
-    try:
-        print sender.objects.get(sender.id).__dict__
-    except:
-        print "new"
+class ChangeLogEntry(models.Model):
+    """
+    Field level changes made to a project, custom field config or pinned custom field, written in batches when the transaction commits
+    """
+    ACTION_CREATED = "created"
+    ACTION_UPDATED = "updated"
+    ACTION_DELETED = "deleted"
+
+    ACTION_CHOICES = [
+        (ACTION_CREATED, "Created"),
+        (ACTION_UPDATED, "Updated"),
+        (ACTION_DELETED, "Deleted"),
+    ]
+
+    content_type = models.ForeignKey(ContentType, help_text="Type of the object that was changed")
+    object_id = models.IntegerField(help_text="Id of the object that was changed")
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, help_text="Whether the object was created, updated or deleted")
+    changes = models.TextField(default="{}", help_text="JSON object mapping each changed field to a list of its old and new values")
+    created = models.DateTimeField(auto_now_add=True, help_text="Date the change was recorded")
+
+    class Meta:
+        index_together = [["content_type", "object_id"]]
+        ordering = ["created", "id"]
+
+    def __unicode__(self):
+        return "%s %s %d" % (self.action, self.content_type, self.object_id)
+
+    @cached_property
+    def change_dict(self):
+        return json.loads(self.changes)
+
+
+class ChangeLogBuffer(object):
+    """Change log entries made inside one transaction or savepoint, written with a single insert when it commits"""
+
+    def __init__(self):
+        self.entries = []
+
+    def __call__(self):
+        ChangeLogEntry.objects.bulk_create(self.entries)
+
+
+def get_change_log_buffer(using):
+    """
+    Return the buffer for the current savepoint of the connection, registering a new one with on_commit when needed.
+    Django drops the on_commit callbacks of savepoints that are rolled back so their entries are dropped too.
+    Outside of a transaction there is no buffer and entries are written straight away.
+
+    Buffers are matched to savepoints through Connection.savepoint_ids and Connection.run_on_commit, which are private
+    to Django and have been checked against Django 1.9 to 3.2. If either is missing there is no buffer either, the
+    entries are then inserted one at a time inside the transaction, which rolls them back just the same
+    """
+    conn = connections[using]
+    hooks = getattr(conn, "run_on_commit", None)
+    savepoint_ids = getattr(conn, "savepoint_ids", None)
+    if not conn.in_atomic_block or hooks is None or savepoint_ids is None:
+        return None
+    registered = [hook[1] for hook in hooks]
+    # a buffer is only still in use while its callback is registered, it is dropped once run or rolled back
+    buffers = dict((key, buffer) for key, buffer in getattr(conn, "change_log_buffers", {}).items() 
+        if any(func is buffer for func in registered))
+    key = tuple(savepoint_ids)
+    if key not in buffers:
+        buffers[key] = ChangeLogBuffer()
+        transaction.on_commit(buffers[key], using=using)
+    conn.change_log_buffers = buffers
+    return buffers[key]
+
+
+def snapshot_fields(instance):
+    """Values of the concrete fields that are loaded on an instance, deferred fields are left out so that no query is run"""
+    return dict((field.attname, instance.__dict__[field.attname]) for field in instance._meta.concrete_fields if field.attname in instance.__dict__)
+
+
+def log_change(instance, action, changes, using):
+    entry = ChangeLogEntry(content_type=ContentType.objects.get_for_model(instance), object_id=instance.pk, 
+        action=action, changes=json.dumps(changes, cls=DjangoJSONEncoder))
+    buffer = get_change_log_buffer(using)
+    if buffer is None:
+        entry.save(using=using)
+    else:
+        buffer.entries.append(entry)
+
+
+def change_log_snapshot(sender, instance, **kwargs):
+    instance._change_log_snapshot = snapshot_fields(instance)
+
+
+def change_log_saved(sender, instance, created, raw=False, using=None, **kwargs):
+    """Compare the saved values with the snapshot taken when the instance was loaded or last saved"""
+    if raw:
+        return
+    before = {} if created else getattr(instance, "_change_log_snapshot", {})
+    after = snapshot_fields(instance)
+    changes = dict((name, [before.get(name), value]) for name, value in after.items() if created or (name in before and before[name] != value))
+    instance._change_log_snapshot = after
+    if changes:
+        log_change(instance, ChangeLogEntry.ACTION_CREATED if created else ChangeLogEntry.ACTION_UPDATED, changes, using)
+
+
+def change_log_deleted(sender, instance, using=None, **kwargs):
+    changes = dict((name, [value, None]) for name, value in snapshot_fields(instance).items())
+    log_change(instance, ChangeLogEntry.ACTION_DELETED, changes, using)
 
-pre_save.connect(print_name, sender=Project, dispatch_uid="proj_key1")
-pre_save.connect(print_name, sender=CustomFieldConfig, dispatch_uid="proj_key2")
-pre_save.connect(print_name, sender=PinnedCustomField, dispatch_uid="proj_key3")
 
+if CBH_CHANGE_LOG:
+    for index, model in enumerate([Project, CustomFieldConfig, PinnedCustomField]):
+        post_init.connect(change_log_snapshot, sender=model, dispatch_uid="change_log_init%d" % index)
+        post_save.connect(change_log_saved, sender=model, dispatch_uid="change_log_save%d" % index)
+        post_delete.connect(change_log_deleted, sender=model, dispatch_uid="change_log_delete%d" % index)
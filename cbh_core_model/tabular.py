@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Streaming readers for tabular uploads (CSV, TSV and XLSX), bounded memory inference
+of the column types and widths that are used to build custom field configs and
+extraction of previews (CSV, TSV, SDF and XLSX) from the start of an upload"""
+import csv
+import numbers
+import os
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+
+TAB_SEPARATED_EXTENSIONS = (".tsv", ".tab", ".txt")
+EXCEL_EXTENSIONS = (".xlsx", ".xlsm")
+
+#Values that pandas would read as missing data
+NULL_VALUES = set(["", "nan", "NaN", "NA", "N/A", "n/a", "NULL", "null", "#N/A", "-NaN", "-nan"])
+
+
+def iter_csv_rows(fileobj, delimiter=","):
+    """Yield the rows of a CSV file one at a time as lists of strings"""
+    for row in csv.reader(fileobj, delimiter=delimiter):
+        yield row
+
+
+def iter_xlsx_rows(fileobj):
+    """Yield the rows of the active sheet of an Excel workbook one at a time, openpyxl read only mode
+    is used so that the cells are not all loaded into memory"""
+    if load_workbook is None:
+        raise ImportError("openpyxl is required to read Excel files")
+    workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows():
+            yield [cell.value for cell in row]
+    finally:
+        if hasattr(workbook, "close"):
+            workbook.close()
+
+
+def iter_rows(fileobj, extension):
+    """Choose a row reader based on the file extension"""
+    extension = extension.lower()
+    if extension in EXCEL_EXTENSIONS:
+        return iter_xlsx_rows(fileobj)
+    if extension in TAB_SEPARATED_EXTENSIONS:
+        return iter_csv_rows(fileobj, delimiter="\t")
+    return iter_csv_rows(fileobj)
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return u"%s" % value
+
+
+class ColumnTypeInferrer(object):
+    """Running summary of a single column, keeps only flags and the maximum width so memory
+    use does not depend on the number of rows. The data type reported mirrors the dtype that
+    pandas would have given the column so it can be passed to PinnedCustomField.pandas_converter"""
+
+    def __init__(self):
+        self.width = 0
+        self.has_missing = False
+        self.is_integer = True
+        self.is_numeric = True
+        self.has_values = False
+
+    def update(self, value):
+        if value is None or (isinstance(value, (bytes, type(u""))) and value.strip() in NULL_VALUES):
+            self.has_missing = True
+            return
+        self.has_values = True
+        self.width = max(self.width, len(_text(value)))
+        if not self.is_numeric:
+            return
+        if isinstance(value, bool):
+            self.is_integer = self.is_numeric = False
+        elif isinstance(value, numbers.Integral):
+            pass
+        elif isinstance(value, float):
+            self.is_integer = self.is_integer and value.is_integer()
+        else:
+            try:
+                int(value)
+            except ValueError:
+                self.is_integer = False
+                try:
+                    float(value)
+                except ValueError:
+                    self.is_numeric = False
+            except TypeError:
+                self.is_integer = self.is_numeric = False
+
+    @property
+    def data_type(self):
+        if not self.has_values:
+            #An empty column is read by pandas as all NaN
+            return "float64"
+        if self.is_integer and not self.has_missing:
+            return "int64"
+        if self.is_numeric:
+            return "float64"
+        return "object"
+
+
+def infer_schema(rows, sample_size=None):
+    """Read the header and then the data rows from an iterable of rows, returning the names,
+    pandas style data types and maximum widths of each column.
+    If sample_size is given then reading stops after that many data rows"""
+    rows = iter(rows)
+    try:
+        header = next(rows)
+    except StopIteration:
+        return [], [], []
+    names = [_text(name).strip() if name is not None else u"" for name in header]
+    columns = [ColumnTypeInferrer() for name in names]
+    for count, row in enumerate(rows):
+        if sample_size is not None and count >= sample_size:
+            break
+        for index, value in enumerate(row[:len(columns)]):
+            columns[index].update(value)
+        for column in columns[len(row):]:
+            column.update(None)
+    return names, [column.data_type for column in columns], [column.width for column in columns]
+
+
+def infer_schema_from_file(source, extension=None, sample_size=None):
+    """Infer the schema of a file, source can be a path, an open file object or a completed CBHFlowFile"""
+    if hasattr(source, "original_filename"):
+        extension = extension or source.extension
+        fileobj = source.file
+        if fileobj is None:
+            raise ValueError("The upload has not completed")
+    elif isinstance(source, (bytes, type(u""))):
+        extension = extension or os.path.splitext(source)[1]
+        fileobj = open(source, "rb")
+    else:
+        extension = extension or os.path.splitext(getattr(source, "name", "") or "")[1]
+        return infer_schema(iter_rows(source, extension), sample_size=sample_size)
+    try:
+        return infer_schema(iter_rows(fileobj, extension), sample_size=sample_size)
+    finally:
+        fileobj.close()
+
+
+CSV = "csv"
+TSV = "tsv"
+SDF = "sdf"
+XLSX = "xlsx"
+
+SDF_EXTENSIONS = (".sdf", ".sd", ".mol")
+SDF_RECORD_END = b"$$$$"
+#Uploads with other extensions, such as images and documents attached to records, are not tables
+PREVIEW_EXTENSIONS = (".csv",) + TAB_SEPARATED_EXTENSIONS + SDF_EXTENSIONS + EXCEL_EXTENSIONS
+
+
+def can_preview(extension):
+    """Whether a preview can be extracted from an upload with this extension"""
+    return (extension or "").lower() in PREVIEW_EXTENSIONS
+
+
+def sniff_file_type(head, extension):
+    """Work out the type of an upload from the first bytes of the file, using the extension to break ties"""
+    extension = (extension or "").lower()
+    if head.startswith(b"PK\x03\x04"):
+        return XLSX
+    if extension in SDF_EXTENSIONS or SDF_RECORD_END in head or b"M  END" in head:
+        return SDF
+    if extension in (".tsv", ".tab"):
+        return TSV
+    try:
+        sample = head[:8192].decode("utf-8", "replace").encode("utf-8")
+        if csv.Sniffer().sniff(sample, delimiters=",\t;").delimiter == "\t":
+            return TSV
+    except csv.Error:
+        pass
+    return CSV
+
+
+def _estimate_total(items_in_sample, sample_bytes, total_size):
+    """Scale the number of items seen in the first sample_bytes of a file up to its total size"""
+    if not items_in_sample or not sample_bytes:
+        return 0
+    return int(round(items_in_sample * float(total_size) / sample_bytes))
+
+
+def _complete_part(head, separator, whole_file):
+    """Drop anything after the last separator in a partial read as it may be cut off"""
+    if whole_file:
+        return head
+    end = head.rfind(separator)
+    return head[:end + len(separator)] if end >= 0 else b""
+
+
+def _delimited_preview(head, delimiter, total_size, whole_file, max_rows):
+    complete = _complete_part(head, b"\n", whole_file)
+    lines = complete.splitlines(True)
+    rows = [[_text(value) for value in row] for row in csv.reader(lines, delimiter=delimiter)]
+    if not rows:
+        return [], [], 0
+    row_count = len(rows) - 1 if whole_file else max(_estimate_total(len(lines), len(complete), total_size) - 1, 0)
+    return rows[0], rows[1:max_rows + 1], row_count
+
+
+def _sdf_preview(head, total_size, whole_file, max_rows):
+    complete = _complete_part(head, SDF_RECORD_END, whole_file)
+    records = [record for record in complete.split(SDF_RECORD_END) if record.strip()]
+    headers = []
+    rows = []
+    for record in records[:max_rows]:
+        values = {}
+        lines = _text(record).splitlines()
+        for index, line in enumerate(lines):
+            if line.startswith(">") and "<" in line and ">" in line[1:]:
+                tag = line[line.index("<") + 1:line.rindex(">")]
+                if tag not in headers:
+                    headers.append(tag)
+                values[tag] = lines[index + 1] if index + 1 < len(lines) else u""
+        rows.append(values)
+    record_count = len(records) if whole_file else _estimate_total(len(records), len(complete), total_size)
+    return headers, [[row.get(tag, u"") for tag in headers] for row in rows], record_count
+
+
+def _xlsx_preview(fileobj, max_rows):
+    if load_workbook is None:
+        raise ImportError("openpyxl is required to read Excel files")
+    workbook = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        rows = []
+        for row in sheet.iter_rows():
+            rows.append([_text(cell.value) if cell.value is not None else u"" for cell in row])
+            if len(rows) > max_rows:
+                break
+        if not rows:
+            return [], [], 0
+        return rows[0], rows[1:], max((sheet.max_row or len(rows)) - 1, 0)
+    finally:
+        if hasattr(workbook, "close"):
+            workbook.close()
+
+
+def extract_preview(fileobj, extension, total_size, max_rows=10, head_bytes=256 * 1024):
+    """
+    Read only the start of a file and return a dictionary describing it, holding the sniffed file type,
+    the column headers, the first max_rows rows and an estimate of the number of rows (records for SDF files)
+    which is exact when the whole file fits in the bytes read. Excel files need the workbook index at the
+    end of the file so they are streamed with openpyxl instead and the row count comes from the sheet dimensions
+    """
+    head = fileobj.read(head_bytes)
+    file_type = sniff_file_type(head, extension)
+    whole_file = len(head) < head_bytes
+    if file_type == XLSX:
+        fileobj.seek(0)
+        headers, rows, row_count = _xlsx_preview(fileobj, max_rows)
+    elif file_type == SDF:
+        headers, rows, row_count = _sdf_preview(head, total_size, whole_file, max_rows)
+    else:
+        delimiter = "\t" if file_type == TSV else ","
+        headers, rows, row_count = _delimited_preview(head, delimiter, total_size, whole_file, max_rows)
+    return {"file_type": file_type, "headers": headers, "rows": rows, "estimated_row_count": row_count}
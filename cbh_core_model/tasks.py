@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""Periodic maintenance jobs, registered as celery tasks when celery is installed
+so they can be added to the beat schedule, otherwise they can be called from any scheduler"""
+from datetime import timedelta
+
+from cbh_core_model.uploads import FLOWJS_STALE_UPLOAD_HOURS, SynchronousAssemblyBackend
+
+try:
+    from celery import shared_task
+except ImportError:
+    shared_task = None
+
+
+def collect_stale_uploads(max_age_hours=FLOWJS_STALE_UPLOAD_HOURS, batch_size=500):
+    """Remove abandoned uploads and their chunk files, returns the number of uploads removed and the bytes reclaimed"""
+    from cbh_core_model.models import CBHFlowFile
+    return CBHFlowFile.objects.collect_stale(timedelta(hours=max_age_hours), batch_size=batch_size)
+
+
+def recover_stuck_assemblies(requeue=True):
+    """Assemble uploads whose assembly job was lost again, or mark them as failed, returns the number recovered.
+    The assemblies are run within the task rather than handed to background threads"""
+    from cbh_core_model.models import CBHFlowFile
+    return CBHFlowFile.objects.recover_assemblies(requeue=requeue, backend=SynchronousAssemblyBackend())
+
+
+if shared_task is not None:
+    collect_stale_uploads = shared_task(collect_stale_uploads)
+    recover_stuck_assemblies = shared_task(recover_stuck_assemblies)
@@ -0,0 +1,812 @@
+# -*- coding: utf-8 -*-
+"""Helpers for assembling and managing Flow.js uploads (CBHFlowFile and CBHFlowFileChunk)"""
+import errno
+import gzip
+import hashlib
+import io
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.utils.module_loading import import_string
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+#Size of the buffer used when copying chunk data into the assembled file
+FLOWJS_JOIN_BUFFER_SIZE = getattr(settings, "FLOWJS_JOIN_BUFFER_SIZE", 1024 * 1024)
+#Dotted path of the backend that runs the assembly of completed uploads
+FLOWJS_ASSEMBLY_BACKEND = getattr(settings, "FLOWJS_ASSEMBLY_BACKEND", "cbh_core_model.uploads.ThreadPoolAssemblyBackend")
+#Number of threads used by the thread pool assembly backend
+FLOWJS_ASSEMBLY_WORKERS = getattr(settings, "FLOWJS_ASSEMBLY_WORKERS", 2)
+#Whether to hash assembled uploads and store identical content only once
+FLOWJS_DEDUPLICATE_UPLOADS = getattr(settings, "FLOWJS_DEDUPLICATE_UPLOADS", False)
+#Whether assembled uploads and chunks are spread over two levels of hashed directories, with a directory per upload for chunks
+FLOWJS_SHARDED_LAYOUT = getattr(settings, "FLOWJS_SHARDED_LAYOUT", False)
+#Whether assembled uploads are compressed at rest, using zstd when the zstandard package is installed and gzip otherwise
+FLOWJS_COMPRESS_UPLOADS = getattr(settings, "FLOWJS_COMPRESS_UPLOADS", False)
+#Local directory that compressed uploads are decompressed into when a plain file is asked for with CBHFlowFile.full_path
+FLOWJS_DECOMPRESSED_DIR = getattr(settings, "FLOWJS_DECOMPRESSED_DIR", None) or os.path.join(tempfile.gettempdir(), "flowjs")
+#Whether a preview of the headers and first rows is extracted from each upload as it completes, and how many rows it holds
+FLOWJS_BUILD_PREVIEWS = getattr(settings, "FLOWJS_BUILD_PREVIEWS", True)
+FLOWJS_PREVIEW_ROWS = getattr(settings, "FLOWJS_PREVIEW_ROWS", 10)
+#Limits on the number of uploads in progress across the system and within a project and on the number being assembled,
+#None means no limit. Uploads created more than FLOWJS_ACTIVE_UPLOAD_MINUTES ago no longer count as in progress
+FLOWJS_MAX_ACTIVE_UPLOADS = getattr(settings, "FLOWJS_MAX_ACTIVE_UPLOADS", None)
+FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT = getattr(settings, "FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT", None)
+FLOWJS_MAX_ACTIVE_ASSEMBLIES = getattr(settings, "FLOWJS_MAX_ACTIVE_ASSEMBLIES", None)
+FLOWJS_ACTIVE_UPLOAD_MINUTES = getattr(settings, "FLOWJS_ACTIVE_UPLOAD_MINUTES", 60)
+#Seconds a client is asked to wait before retrying an upload turned away by the limits
+FLOWJS_RETRY_AFTER = getattr(settings, "FLOWJS_RETRY_AFTER", 30)
+#Age in hours after which unfinished or failed uploads are removed by the cleanup_flowfiles command
+FLOWJS_STALE_UPLOAD_HOURS = getattr(settings, "FLOWJS_STALE_UPLOAD_HOURS", 72)
+#Uploads that have been assembling for longer than this are taken to have lost their assembly job
+FLOWJS_ASSEMBLY_TIMEOUT_MINUTES = getattr(settings, "FLOWJS_ASSEMBLY_TIMEOUT_MINUTES", 30)
+#Threads that write chunks handed over with CBHFlowFile.ingest_chunk and the most chunks that may wait for them
+FLOWJS_INGEST_WORKERS = getattr(settings, "FLOWJS_INGEST_WORKERS", 8)
+FLOWJS_MAX_PENDING_CHUNKS = getattr(settings, "FLOWJS_MAX_PENDING_CHUNKS", 256)
+
+
+def _write_all(target, data):
+    """Unbuffered files may accept only part of a write, keep writing until all of the data is written"""
+    view = memoryview(data)
+    while len(view):
+        written = target.write(view)
+        if written is None:
+            #Buffered file objects write everything and may return None
+            break
+        view = view[written:]
+
+
+def copy_stream(source, target, buffer_size=FLOWJS_JOIN_BUFFER_SIZE, digest=None):
+    """Copy one file object into another through a fixed size buffer so that peak memory
+    does not depend on the size of the source, returns the number of bytes copied.
+    If a hashlib object is given as digest it is updated with the data as it is copied"""
+    copied = 0
+    while True:
+        data = source.read(buffer_size)
+        if not data:
+            break
+        if digest is not None:
+            digest.update(data)
+        if target is not None:
+            _write_all(target, data)
+        copied += len(data)
+    return copied
+
+
+def copy_fd_zero_copy(source_fd, target_fd, buffer_size=FLOWJS_JOIN_BUFFER_SIZE):
+    """Copy the remainder of one file descriptor to another inside the kernel using
+    os.copy_file_range or os.sendfile where the platform provides them.
+    Returns the number of bytes copied or None if no zero copy method is available"""
+    copy_func = getattr(os, "copy_file_range", None)
+    if copy_func is None:
+        sendfile = getattr(os, "sendfile", None)
+        if sendfile is None:
+            return None
+        copy_func = lambda src, dst, count: sendfile(dst, src, None, count)
+    copied = 0
+    try:
+        while True:
+            sent = copy_func(source_fd, target_fd, buffer_size)
+            if not sent:
+                break
+            copied += sent
+    except OSError:
+        if copied:
+            raise
+        #e.g. copying across filesystems which do not support it, use a normal copy instead
+        return None
+    return copied
+
+
+def local_path(fieldfile):
+    """Return the local filesystem path of a stored file or None for remote storage"""
+    try:
+        return fieldfile.path
+    except NotImplementedError:
+        return None
+
+
+def append_local_file(path, target, buffer_size=FLOWJS_JOIN_BUFFER_SIZE, digest=None):
+    """Append the contents of a local file to an open unbuffered target file using a kernel copy,
+    the data has to pass through a buffer when it is being hashed or the target is not a real file"""
+    with io.open(path, "rb", buffering=0) as source:
+        if digest is None and hasattr(target, "fileno"):
+            copied = copy_fd_zero_copy(source.fileno(), target.fileno(), buffer_size)
+            if copied is not None:
+                return copied
+        return copy_stream(source, target, buffer_size, digest)
+
+
+def append_file(fieldfile, target, buffer_size=FLOWJS_JOIN_BUFFER_SIZE, digest=None):
+    """Append the contents of a stored file to an open unbuffered target file,
+    using a kernel copy for local files and a buffered stream copy otherwise"""
+    path = local_path(fieldfile)
+    if path is not None:
+        return append_local_file(path, target, buffer_size, digest)
+    fieldfile.open("rb")
+    try:
+        return copy_stream(fieldfile, target, buffer_size, digest)
+    finally:
+        fieldfile.close()
+
+
+def upload_shard(identifier):
+    """Two levels of directories taken from a hash of the upload identifier, e.g. 3f/a2"""
+    hashed = hashlib.sha1(identifier.encode("utf-8")).hexdigest()
+    return os.path.join(hashed[0:2], hashed[2:4])
+
+
+def delete_stored_files(storage, names, directory=None):
+    """Remove a list of stored files in one pass. Local files are unlinked directly rather than through
+    a storage call per file, and if the files are grouped in a directory of their own the whole
+    directory is removed at once. Other storage backends fall back to deleting each file"""
+    try:
+        if directory is not None:
+            shutil.rmtree(storage.path(directory), ignore_errors=True)
+            return
+        paths = [storage.path(name) for name in names]
+    except NotImplementedError:
+        for name in names:
+            storage.delete(name)
+        return
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def move_stored_file(storage, name, new_name):
+    """
+    Rename a local stored file, creating directories as needed. Storage backends without local paths have the file
+    copied to the new name and the old one deleted. Returns the name the file was moved to or False if there was no file to move
+    """
+    try:
+        source = storage.path(name)
+    except NotImplementedError:
+        if not storage.exists(name):
+            return False
+        if storage.exists(new_name):
+            storage.delete(new_name)
+        with storage.open(name) as stored:
+            new_name = storage.save(new_name, stored)
+        storage.delete(name)
+        return new_name
+    if not os.path.exists(source):
+        return False
+    target = storage.path(new_name)
+    directory = os.path.dirname(target)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    os.rename(source, target)
+    return new_name
+
+
+def move_to_content_store(storage, name, content_name, shared):
+    """Move an assembled file to its content addressed name. If shared is set, because other uploads already
+    refer to identical content stored there, the new copy is removed instead. A file left at the content addressed
+    name by an upload that has since been deleted is replaced. Storage backends without local paths cannot
+    rename files cheaply so a new file is left where it is. Returns the name the content is stored under"""
+    if shared and storage.exists(content_name):
+        storage.delete(name)
+        return content_name
+    try:
+        source = storage.path(name)
+        target = storage.path(content_name)
+    except NotImplementedError:
+        return name
+    directory = os.path.dirname(target)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    os.rename(source, target)
+    return content_name
+
+
+def open_local_target(storage, name):
+    """Open a file for writing at the storage location for name, creating directories as needed"""
+    path = storage.path(name)
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return io.open(path, "wb", buffering=0)
+
+
+def preallocate_file(path, size):
+    """Create a file of the given size at path without truncating one that already exists,
+    so that chunks arriving concurrently can each be written straight to their offset"""
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fallocate = getattr(os, "posix_fallocate", None)
+        if fallocate is not None and size:
+            try:
+                fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _write_at(fd, data, offset):
+    """Write all of data to the file descriptor at offset without moving any shared file position"""
+    pwrite = getattr(os, "pwrite", None)
+    view = memoryview(data)
+    while len(view):
+        if pwrite is not None:
+            written = pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def write_at_offset(path, source, offset, buffer_size=FLOWJS_JOIN_BUFFER_SIZE):
+    """Write the contents of a file object or a byte string into an existing file at the given offset,
+    returns the number of bytes written"""
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    fd = os.open(path, os.O_WRONLY)
+    written = 0
+    try:
+        while True:
+            data = source.read(buffer_size)
+            if not data:
+                break
+            _write_at(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+    return written
+
+
+def empty_bitmap(total_chunks):
+    """A bitmap with one unset bit for each chunk"""
+    return bytearray((total_chunks + 7) // 8)
+
+
+def chunk_bit(number):
+    """Flow.js numbers chunks from 1, return the byte index and bit mask for a chunk number.
+    Bits are stored least significant first to match the PostgreSQL get_bit and set_bit functions on bytea"""
+    index = number - 1
+    return index >> 3, 1 << (index & 7)
+
+
+def bitmap_has_chunk(bitmap, number):
+    byte, mask = chunk_bit(number)
+    bitmap = bytearray(bitmap or b"")
+    return byte < len(bitmap) and bool(bitmap[byte] & mask)
+
+
+def set_bitmap_chunk(bitmap, number):
+    """Return a copy of the bitmap with the bit for the chunk number set"""
+    bitmap = bytearray(bitmap or b"")
+    byte, mask = chunk_bit(number)
+    if byte >= len(bitmap):
+        bitmap.extend(bytearray(byte + 1 - len(bitmap)))
+    bitmap[byte] |= mask
+    return bitmap
+
+
+def missing_bitmap_chunks(bitmap, total_chunks):
+    """Return the chunk numbers from 1 to total_chunks whose bits are not set"""
+    bitmap = bytearray(bitmap or b"")
+    missing = []
+    for byte_index in range((total_chunks + 7) // 8):
+        byte = bitmap[byte_index] if byte_index < len(bitmap) else 0
+        if byte == 0xff:
+            continue
+        for bit in range(8):
+            number = byte_index * 8 + bit + 1
+            if number <= total_chunks and not byte & (1 << bit):
+                missing.append(number)
+    return missing
+
+
+def count_bitmap_chunks(bitmap):
+    return sum(bin(byte).count("1") for byte in bytearray(bitmap or b""))
+
+
+class UploadBackpressure(Exception):
+    """Raised when a new upload would go over the configured concurrency limits, the client should try again later"""
+    status_code = 503
+
+    def __init__(self, message, retry_after=None):
+        super(UploadBackpressure, self).__init__(message)
+        self.retry_after = retry_after or FLOWJS_RETRY_AFTER
+
+
+class PipelineCounters(object):
+    """Thread safe counters of how often uploads were turned away, kept per process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rejected = {}
+
+    def reject(self, reason):
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return {"rejected": dict(self.rejected)}
+
+
+pipeline_counters = PipelineCounters()
+
+
+class SynchronousAssemblyBackend(object):
+    """Run assembly jobs immediately in the calling thread"""
+
+    def submit(self, func, *args):
+        func(*args)
+
+    def stats(self):
+        return {"queue_depth": 0}
+
+
+class DaemonThreadPool(object):
+    """Pool of daemon threads fed from a local queue, the threads are started on first use"""
+    thread_name = "flowjs-worker"
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="%s-%d" % (self.thread_name, len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self):
+        raise NotImplementedError
+
+
+class ThreadPoolAssemblyBackend(DaemonThreadPool):
+    """Run assembly jobs on a pool of daemon threads fed from a local queue so that
+    the request carrying the final chunk can return straight away"""
+    thread_name = "flowjs-assembly"
+
+    def __init__(self, workers=None):
+        super(ThreadPoolAssemblyBackend, self).__init__(workers or FLOWJS_ASSEMBLY_WORKERS)
+        self.jobs_started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _run(self):
+        while True:
+            func, args, queued_at = self.queue.get()
+            wait = time.time() - queued_at
+            with self.lock:
+                self.jobs_started += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Assembly job %s%r failed", getattr(func, "__name__", func), args)
+            finally:
+                #Each thread gets its own database connection, do not leave it open between jobs
+                connection.close()
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        self._start()
+        self.queue.put((func, args, time.time()))
+
+    def stats(self):
+        """Queue depth and the time jobs have waited in the queue before starting, for tuning the number of workers"""
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "workers": self.workers,
+                "jobs_started": self.jobs_started,
+                "mean_wait_seconds": self.total_wait / self.jobs_started if self.jobs_started else 0.0,
+                "max_wait_seconds": self.max_wait,
+            }
+
+
+_assembly_backend = None
+
+
+def get_assembly_backend():
+    """Return the configured assembly backend, created on first use"""
+    global _assembly_backend
+    if _assembly_backend is None:
+        _assembly_backend = import_string(FLOWJS_ASSEMBLY_BACKEND)()
+    return _assembly_backend
+
+
+class DetachedChunk(object):
+    """Chunk data taken off the request it arrived with so that it can be written after the request has finished.
+    Small uploads are already in memory and are kept as bytes, uploads spooled to a temporary file are hard
+    linked to a new name, which Django does not delete when the request closes its files"""
+
+    def __init__(self, data):
+        self.content = None
+        self.path = None
+        temporary_file_path = getattr(data, "temporary_file_path", None)
+        if temporary_file_path is not None:
+            source = temporary_file_path()
+            fd, self.path = tempfile.mkstemp(prefix="flowjs-chunk-", dir=os.path.dirname(source))
+            os.close(fd)
+            os.remove(self.path)
+            try:
+                os.link(source, self.path)
+            except OSError:
+                #Hard links are not supported on every filesystem
+                shutil.copyfile(source, self.path)
+        elif hasattr(data, "read"):
+            if hasattr(data, "seek"):
+                data.seek(0)
+            self.content = data.read()
+        else:
+            self.content = data
+
+    def open(self, name):
+        """Return the data as a Django File with the given name, ready to be saved to a FileField"""
+        if self.path is not None:
+            return File(open(self.path, "rb"), name=name)
+        return ContentFile(self.content, name=name)
+
+    def discard(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PendingChunk(object):
+    """Handle on a chunk handed to the ingestion pool"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the chunk to be written and return the new count of uploaded chunks, or None if the timeout passed.
+        An error raised while writing the chunk is raised again here"""
+        if not self.event.wait(timeout):
+            return None
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ChunkIngestionPool(DaemonThreadPool):
+    """Write chunks and record their arrival on a pool of daemon threads so that the request carrying a chunk
+    is not held for the storage write and the counter update. The number of chunks waiting to be written is
+    bounded, once it is reached further chunks are turned away with UploadBackpressure"""
+    thread_name = "flowjs-ingest"
+
+    def __init__(self, workers=None, max_pending=None):
+        super(ChunkIngestionPool, self).__init__(workers or FLOWJS_INGEST_WORKERS)
+        self.max_pending = max_pending or FLOWJS_MAX_PENDING_CHUNKS
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _run(self):
+        while True:
+            func, args, pending = self.queue.get()
+            try:
+                pending.result = func(*args)
+            except Exception as error:
+                logger.exception("Chunk ingestion job %s%r failed", getattr(func, "__name__", func), args)
+                pending.error = error
+            finally:
+                connection.close()
+                self.slots.release()
+                pending.event.set()
+                self.queue.task_done()
+
+    def submit(self, func, *args):
+        if not self.slots.acquire(False):
+            pipeline_counters.reject("pending_chunks")
+            raise UploadBackpressure("Too many chunks are waiting to be written, try again later")
+        pending = PendingChunk()
+        self._start()
+        self.queue.put((func, args, pending))
+        return pending
+
+    def stats(self):
+        return {"queue_depth": self.queue.qsize(), "workers": self.workers, "max_pending": self.max_pending}
+
+
+_chunk_ingestor = None
+_chunk_ingestor_lock = threading.Lock()
+
+
+def get_chunk_ingestor():
+    """Return the process wide chunk ingestion pool, created on first use"""
+    global _chunk_ingestor
+    with _chunk_ingestor_lock:
+        if _chunk_ingestor is None:
+            _chunk_ingestor = ChunkIngestionPool()
+    return _chunk_ingestor
+
+
+def open_local_mmap(path):
+    """Memory map a local file read only"""
+    with io.open(path, "rb") as fileobj:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def zero_copy_slice(mapped, offset, length):
+    """A view of part of a memory map which does not copy the bytes onto the Python heap"""
+    end = min(offset + length, len(mapped))
+    try:
+        return memoryview(mapped)[offset:end]
+    except TypeError:
+        #Python 2 memory maps only support the old buffer interface
+        return buffer(mapped, offset, max(end - offset, 0))
+
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+
+#Formats that are compressed already, including zip based ones such as xlsx which their readers open with random access
+PRECOMPRESSED_EXTENSIONS = (".xlsx", ".xlsm", ".docx", ".pptx", ".zip", ".gz", ".bz2", ".xz", ".zst",
+    ".png", ".jpg", ".jpeg", ".gif", ".pdf")
+
+
+def default_compression(extension=""):
+    """The compression to use for a newly assembled upload with the given extension, an empty string when
+    compression is turned off or the format is already compressed"""
+    if not FLOWJS_COMPRESS_UPLOADS or (extension or "").lower() in PRECOMPRESSED_EXTENSIONS:
+        return ""
+    return ZSTD if zstandard is not None else GZIP
+
+
+class CompressingWriter(object):
+    """Compress data as it is written to an open target file, close writes the end of the
+    compressed stream without closing the target"""
+
+    def __init__(self, target, compression):
+        self.target = target
+        if compression == ZSTD:
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            #wbits of 31 gives a gzip header and trailer
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        _write_all(self.target, self.compressor.compress(data))
+
+    def close(self):
+        _write_all(self.target, self.compressor.flush())
+
+
+class DecompressingFile(File):
+    """
+    Read only Django File which decompresses a stored file as a stream, supports reading, seeking, iterating over lines
+    and the File API such as chunks() and size. Compressed streams can only be read forwards, so seeking backwards starts
+    decompressing again from the beginning and seeking from the end or asking for the size needs the uncompressed size,
+    which is read through the file when it is not given. Readers that jump around a file, such as zip readers, should be
+    given a copy in a temporary file instead, see decompress_to_path
+    """
+
+    def __init__(self, fileobj, compression, size=None, name=None):
+        if compression == ZSTD and zstandard is None:
+            raise ImportError("zstandard is required to read zstd compressed uploads")
+        super(DecompressingFile, self).__init__(fileobj, name)
+        self.fileobj = fileobj
+        self.compression = compression
+        self._size = size
+        self._open_stream()
+
+    def _open_stream(self):
+        self.fileobj.seek(0)
+        if self.compression == ZSTD:
+            self.stream = zstandard.ZstdDecompressor().stream_reader(self.fileobj)
+        else:
+            self.stream = gzip.GzipFile(fileobj=self.fileobj, mode="rb")
+        self.position = 0
+
+    def _read_to_end(self):
+        while self.read(FLOWJS_JOIN_BUFFER_SIZE):
+            pass
+        self._size = self.position
+
+    @property
+    def size(self):
+        """The uncompressed size, found by reading through the file when it was not given"""
+        if self._size is None:
+            position = self.position
+            self._read_to_end()
+            self.seek(position)
+        return self._size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = b"".join(iter(lambda: self.stream.read(FLOWJS_JOIN_BUFFER_SIZE), b""))
+        else:
+            data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            if self._size is None:
+                self._read_to_end()
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+        if offset < self.position:
+            self._open_stream()
+        while self.position < offset:
+            if not self.read(min(FLOWJS_JOIN_BUFFER_SIZE, offset - self.position)):
+                break
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def _unsupported(self, *args, **kwargs):
+        raise io.UnsupportedOperation("Compressed uploads can only be read in blocks or by iterating over their lines")
+
+    #the descriptor and the line reading of the underlying file would give compressed data
+    fileno = readinto = readline = write = writelines = truncate = _unsupported
+
+    def readlines(self):
+        return list(self)
+
+    def __bool__(self):
+        #File is false without a name, but readers such as zipfile test the file object they are given
+        return True
+
+    def __iter__(self):
+        pending = b""
+        while True:
+            data = self.read(FLOWJS_JOIN_BUFFER_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if pending:
+            yield pending
+
+    def open(self, mode=None):
+        if self.closed:
+            raise ValueError("A closed compressed upload cannot be reopened, open it through the storage again")
+        self.seek(0)
+        return self
+
+    def close(self):
+        self.stream.close()
+        self.fileobj.close()
+
+
+def decompress_to_path(stored, path):
+    """
+    Write the contents of a DecompressingFile to a local path, through a temporary file in the same directory
+    which is renamed into place so that a partial copy is never seen at the path. Returns the path
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    handle, temporary = tempfile.mkstemp(dir=directory)
+    try:
+        with io.open(handle, "wb") as target:
+            for data in stored.chunks(FLOWJS_JOIN_BUFFER_SIZE):
+                target.write(data)
+        os.rename(temporary, path)
+    except Exception:
+        os.remove(temporary)
+        raise
+    return path
+
+
+class LocalComposer(object):
+    """Joins stored files on the local filesystem, copying between files inside the kernel where possible"""
+    composes_remotely = False
+    has_local_paths = True
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def compose(self, sources, target, digest=None, compression=""):
+        """Write the concatenation of the source names to the target name, optionally hashing
+        and compressing the data on the way. Returns the size of the stored target"""
+        with open_local_target(self.storage, target) as stored:
+            writer = CompressingWriter(stored, compression) if compression else stored
+            for name in sources:
+                append_local_file(self.storage.path(name), writer, digest=digest)
+            if compression:
+                writer.close()
+            return stored.tell()
+
+
+class ObjectStoreComposer(object):
+    """
+    Joins stored files on a storage backend without local paths. Backends that can concatenate objects on
+    the server side expose this as compose(names, target) and are used directly so the chunk bytes never pass
+    through the web worker. Otherwise, or when the data has to be hashed or compressed, the chunks are streamed
+    into a temporary file which is then saved to the storage
+    """
+    has_local_paths = False
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def composes_remotely(self):
+        return hasattr(self.storage, "compose")
+
+    def compose(self, sources, target, digest=None, compression=""):
+        if self.composes_remotely and digest is None and not compression:
+            self.storage.compose(list(sources), target)
+            return self.storage.size(target)
+        with tempfile.TemporaryFile() as spool:
+            writer = CompressingWriter(spool, compression) if compression else spool
+            for name in sources:
+                with self.storage.open(name) as source:
+                    copy_stream(source, writer, digest=digest)
+            if compression:
+                writer.close()
+            size = spool.tell()
+            spool.seek(0)
+            if self.storage.exists(target):
+                self.storage.delete(target)
+            self.storage.save(target, File(spool))
+            return size
+
+
+def get_composer(storage):
+    """Choose how to join files based on whether the storage has local paths"""
+    try:
+        storage.path("")
+    except NotImplementedError:
+        return ObjectStoreComposer(storage)
+    return LocalComposer(storage)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Validation of parsed uploads against the PinnedCustomField definitions of a custom field config.
+Large uploads are split into row blocks and validated in a pool of worker processes"""
+import multiprocessing
+
+from django.conf import settings
+
+from cbh_core_model.models import validate_value
+
+#Number of worker processes, defaults to the number of cpus on the machine
+VALIDATION_WORKERS = getattr(settings, "CBH_VALIDATION_WORKERS", None)
+#Number of rows sent to a worker at a time
+VALIDATION_BLOCK_ROWS = getattr(settings, "CBH_VALIDATION_BLOCK_ROWS", 10000)
+#Uploads with fewer cells than this are validated in the calling process
+VALIDATION_SERIAL_THRESHOLD = getattr(settings, "CBH_VALIDATION_SERIAL_THRESHOLD", 200000)
+
+
+_worker_specs = None
+
+
+def compile_field_specs(pinned_custom_fields):
+    """Reduce a list of PinnedCustomField objects to the picklable specs used for validation"""
+    return [pcf.validation_spec for pcf in pinned_custom_fields]
+
+
+def validate_rows(specs, rows, start=0):
+    """Validate a list of row dictionaries keyed by field name, returning a list of errors in row order.
+    Each error is a dictionary containing the row index, the field name and the offending value"""
+    errors = []
+    for index, row in enumerate(rows, start):
+        for name, required, test_datatype in specs:
+            value = row.get(name, None)
+            if not validate_value(test_datatype, required, value):
+                errors.append({"row": index, "field": name, "value": value})
+    return errors
+
+
+def _init_worker(specs):
+    """Store the field specs once per worker process rather than pickling them with every block"""
+    global _worker_specs
+    _worker_specs = specs
+
+
+def _validate_block(block):
+    start, rows = block
+    return validate_rows(_worker_specs, rows, start)
+
+
+def _iter_blocks(rows, block_rows):
+    for start in range(0, len(rows), block_rows):
+        yield (start, rows[start:start + block_rows])
+
+
+def validate_upload(pinned_custom_fields, rows, workers=None, block_rows=None):
+    """Validate all of the rows of a parsed upload against the given PinnedCustomField objects.
+    Small uploads are validated serially, larger ones are split into blocks of rows and validated by
+    a pool of worker processes. Errors are returned in row order whichever path is taken"""
+    specs = compile_field_specs(pinned_custom_fields)
+    workers = workers or VALIDATION_WORKERS or multiprocessing.cpu_count()
+    block_rows = block_rows or VALIDATION_BLOCK_ROWS
+    if workers < 2 or len(rows) * len(specs) < VALIDATION_SERIAL_THRESHOLD or len(rows) <= block_rows:
+        return validate_rows(specs, rows)
+
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(specs,))
+    try:
+        errors = []
+        #imap keeps the results in the order the blocks were submitted
+        for block_errors in pool.imap(_validate_block, _iter_blocks(rows, block_rows)):
+            errors.extend(block_errors)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return errors
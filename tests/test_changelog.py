@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_changelog
+--------------
+
+Tests for the change log written by `cbh_core_model.models.ChangeLogEntry` when CBH_CHANGE_LOG is on.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.test import TransactionTestCase
+
+from cbh_core_model.models import (ChangeLogEntry, CustomFieldConfig, PinnedCustomField,
+    change_log_snapshot, change_log_saved, change_log_deleted)
+
+
+class TestChangeLog(TransactionTestCase):
+    """Runs outside a test transaction so that the buffered entries are written on commit"""
+
+    def setUp(self):
+        #The receivers are only connected at import time when CBH_CHANGE_LOG is on
+        for model in (CustomFieldConfig, PinnedCustomField):
+            post_init.connect(change_log_snapshot, sender=model, dispatch_uid="test_change_log_init")
+            post_save.connect(change_log_saved, sender=model, dispatch_uid="test_change_log_save")
+            post_delete.connect(change_log_deleted, sender=model, dispatch_uid="test_change_log_delete")
+        self.user = User.objects.create(username="changer")
+
+    def logged(self):
+        return list(ChangeLogEntry.objects.order_by("id").values_list("object_id", "action"))
+
+    def test_outside_a_transaction(self):
+        config = CustomFieldConfig.objects.create(name="config", created_by=self.user)
+        self.assertEqual(self.logged(), [(config.pk, ChangeLogEntry.ACTION_CREATED)])
+
+    def test_written_when_the_transaction_commits(self):
+        with transaction.atomic():
+            config = CustomFieldConfig.objects.create(name="config", created_by=self.user)
+            config.name = "renamed"
+            config.save()
+            self.assertEqual(self.logged(), [])
+        self.assertEqual(self.logged(), [(config.pk, ChangeLogEntry.ACTION_CREATED), (config.pk, ChangeLogEntry.ACTION_UPDATED)])
+
+    def test_rolled_back_savepoint_is_not_logged(self):
+        with transaction.atomic():
+            config = CustomFieldConfig.objects.create(name="config", created_by=self.user)
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    PinnedCustomField.objects.create(custom_field_config=config, name="Dropped", position=0)
+                    raise RuntimeError
+            #Entries made after the rollback still reach the log
+            pcf = PinnedCustomField.objects.create(custom_field_config=config, name="Kept", position=0)
+        self.assertEqual(self.logged(), [(config.pk, ChangeLogEntry.ACTION_CREATED), (pcf.pk, ChangeLogEntry.ACTION_CREATED)])
+
+    def test_committed_savepoint_is_logged(self):
+        with transaction.atomic():
+            config = CustomFieldConfig.objects.create(name="config", created_by=self.user)
+            with transaction.atomic():
+                pcf = PinnedCustomField.objects.create(custom_field_config=config, name="Kept", position=0)
+        self.assertEqual(sorted(self.logged()), sorted([(config.pk, ChangeLogEntry.ACTION_CREATED), (pcf.pk, ChangeLogEntry.ACTION_CREATED)]))
+
+    def test_rolled_back_transaction_is_not_logged(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                CustomFieldConfig.objects.create(name="config", created_by=self.user)
+                raise RuntimeError
+        self.assertEqual(self.logged(), [])
+
+    def tearDown(self):
+        for model in (CustomFieldConfig, PinnedCustomField):
+            post_init.disconnect(sender=model, dispatch_uid="test_change_log_init")
+            post_save.disconnect(sender=model, dispatch_uid="test_change_log_save")
+            post_delete.disconnect(sender=model, dispatch_uid="test_change_log_delete")
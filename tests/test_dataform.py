@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_dataform
+-------------
+
+Tests for the hierarchy of `cbh_core_model.models.DataFormConfig`.
+"""
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+
+from cbh_core_model.models import CustomFieldConfig, DataFormConfig, DATA_FORM_LEVELS, get_data_form_path
+
+
+class TestDataFormPath(SimpleTestCase):
+
+    def test_levels_that_are_set(self):
+        self.assertEqual(get_data_form_path((12, 7, 33, None, None)), "12/7/33")
+
+    def test_gaps_do_not_collide(self):
+        self.assertEqual(get_data_form_path((12, None, 33, None, None)), "12//33")
+        self.assertEqual(get_data_form_path((12, 33, None, None, None)), "12/33")
+
+
+class DataFormTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="former")
+        self.configs = [CustomFieldConfig.objects.create(name="level %d" % number, created_by=self.user) for number in range(6)]
+
+    def create_form(self, *indexes):
+        """A data form config whose levels are the configs at the given indexes, None leaves a level unset"""
+        levels = dict(("l%d" % level, None if index is None else self.configs[index]) for level, index in enumerate(indexes))
+        return DataFormConfig.objects.create(created_by=self.user, **levels)
+
+
+class TestDataFormHierarchy(DataFormTestCase):
+
+    def test_gapped_forms_are_kept_apart(self):
+        gapped = self.create_form(0, None, 1)
+        direct = self.create_form(0, 1)
+        self.assertNotEqual(gapped.path, direct.path)
+        self.assertEqual(gapped.depth, 2)
+        self.assertEqual(direct.depth, 1)
+
+    def test_ancestors_skip_unset_levels(self):
+        top = self.create_form(0)
+        self.create_form(0, 1)
+        gapped = self.create_form(0, None, 1, 2)
+        middle = self.create_form(0, None, 1)
+        self.assertEqual(list(gapped.get_ancestors()), [top, middle])
+
+    def test_descendants_at_depth(self):
+        top = self.create_form(0)
+        direct = self.create_form(0, 1)
+        gapped = self.create_form(0, None, 2)
+        deepest = self.create_form(0, 1, 2, 3, 4)
+        self.assertEqual(set(top.get_descendants()), set([direct, gapped, deepest]))
+        self.assertEqual(list(top.get_descendants_at_depth(1)), [direct])
+        self.assertEqual(list(top.get_descendants_at_depth(2)), [gapped])
+        self.assertEqual(list(top.get_descendants_at_depth(4)), [deepest])
+        with self.assertRaises(ValueError):
+            top.get_descendants_at_depth(5)
+
+
+class TestBackfillPaths(DataFormTestCase):
+
+    def setUp(self):
+        super(TestBackfillPaths, self).setUp()
+        self.top = self.create_form(0)
+        self.direct = self.create_form(0, 1)
+        self.gapped = self.create_form(0, None, 1)
+        self.deepest = self.create_form(0, 1, 2, 3, 4)
+        self.other = self.create_form(5)
+        #Configs saved before the path field existed
+        DataFormConfig.objects.update(path="")
+
+    def backfill(self, *args):
+        output = StringIO()
+        call_command("backfill_dataform_paths", *args, stdout=output)
+        return output.getvalue().strip()
+
+    def paths(self):
+        return dict(DataFormConfig.objects.values_list("pk", "path"))
+
+    def test_paths_are_set(self):
+        self.assertEqual(self.backfill("--batch-size", "2"), "Set the path of 5 data form configs")
+        top, second = self.configs[0].pk, self.configs[1].pk
+        self.assertEqual(self.paths(), {
+            self.top.pk: "%d" % top,
+            self.direct.pk: "%d/%d" % (top, second),
+            self.gapped.pk: "%d//%d" % (top, second),
+            self.deepest.pk: "/".join("%d" % config.pk for config in self.configs[:5]),
+            self.other.pk: "%d" % self.configs[5].pk,
+        })
+        self.assertEqual(self.backfill(), "Set the path of 0 data form configs")
+
+    def test_subtree_after_backfill(self):
+        self.assertFalse(DataFormConfig.objects.subtree(self.top.path).exists())
+        self.backfill()
+        top = DataFormConfig.objects.get(pk=self.top.pk)
+        self.assertEqual(set(DataFormConfig.objects.subtree(top.path)), set([self.top, self.direct, self.gapped, self.deepest]))
+        self.assertEqual(set(DataFormConfig.objects.subtree(top.path, include_self=False)),
+            set([self.direct, self.gapped, self.deepest]))
+        direct = DataFormConfig.objects.get(pk=self.direct.pk)
+        #The gapped config shares the first two ids but is not below the direct one
+        self.assertEqual(set(DataFormConfig.objects.subtree(direct.path)), set([self.direct, self.deepest]))
+
+    def test_dry_run(self):
+        self.assertEqual(self.backfill("--dry-run"), "Would set the path of 5 data form configs")
+        self.assertEqual(set(self.paths().values()), set([""]))
+
+
+def old_get_all_ancestor_objects(obj, user, tree_builder, uri_stub=""):
+    """DataFormConfig.get_all_ancestor_objects as it was before build_tree, one get_or_create and save per ancestor"""
+    levels = ["%s_id" % l for l in ["l0", "l1", "l2", "l3", "l4"]]
+    used_levels = []
+    for lev in levels:
+        if getattr(obj, lev) is not None and lev != "%s_id" % obj.last_level():
+            used_levels.append(lev)
+    filters = []
+    for i in range(1, len(used_levels) + 1):
+        filters.insert(0, dict((lev, getattr(obj, lev)) for lev in used_levels[:i]))
+    for index, filter_set in enumerate(filters):
+        defaults = dict((lev, None) for lev in levels)
+        defaults.update(filter_set)
+        defaults["defaults"] = {"created_by_id": user.id, "human_added": False}
+        new_object, created = DataFormConfig.objects.get_or_create(**defaults)
+        if not obj.parent_id:
+            obj.parent_id = new_object.id
+            obj.save()
+        key = "%s/%d" % (uri_stub, new_object.id)
+        tree_builder[key] = list(set(tree_builder.get(key, []) + [obj]))
+        obj = new_object
+        if index == len(filters) - 1:
+            tree_builder["root"] = [obj]
+    return tree_builder
+
+
+class TestBuildTree(DataFormTestCase):
+
+    def levels(self, config):
+        return tuple(getattr(config, level) for level in DATA_FORM_LEVELS)
+
+    def outcome(self, tree):
+        """The tree and the parent links of every config in terms of levels, so that ids do not matter"""
+        by_id = dict((config.pk, self.levels(config)) for config in DataFormConfig.objects.all())
+        described = {}
+        for key, children in tree.items():
+            name = "root" if key == "root" else by_id[int(key.rsplit("/", 1)[1])]
+            described[name] = set(self.levels(child) for child in children)
+        parents = dict((self.levels(config), by_id.get(config.parent_id)) for config in DataFormConfig.objects.all())
+        return described, parents
+
+    def compare(self, *forms):
+        """Run the old algorithm in a savepoint that is rolled back, then build_tree on the same rows"""
+        configs = [self.create_form(*indexes) for indexes in forms]
+        try:
+            with transaction.atomic():
+                tree = {}
+                for config in DataFormConfig.objects.filter(pk__in=[config.pk for config in configs]):
+                    old_get_all_ancestor_objects(config, self.user, tree, uri_stub="/forms")
+                expected = self.outcome(tree)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        configs = list(DataFormConfig.objects.filter(pk__in=[config.pk for config in configs]))
+        self.assertEqual(self.outcome(DataFormConfig.objects.build_tree(configs, self.user, uri_stub="/forms")), expected)
+
+    def test_single_chain(self):
+        self.compare((0, 1, 2, 3, 4))
+
+    def test_gapped_chain(self):
+        self.compare((0, None, 2, None, 4))
+
+    def test_existing_ancestors_are_reused(self):
+        self.create_form(0)
+        self.create_form(0, 1)
+        self.compare((0, 1, 2))
+
+    def test_siblings_share_their_ancestors(self):
+        self.compare((0, 1, 2), (0, 1, 3), (0, 4))
+
+    def test_queries_do_not_grow_with_the_configs(self):
+        one = [self.create_form(1, 2, 3, 4)]
+        many = [self.create_form(0, 1, 2, index) for index in (3, 4, 5)] + [self.create_form(0, 5, 1, 2, 3)]
+        with CaptureQueriesContext(connection) as single:
+            DataFormConfig.objects.build_tree(one, self.user)
+        with CaptureQueriesContext(connection) as several:
+            DataFormConfig.objects.build_tree(many, self.user)
+        self.assertEqual(len(several), len(single))
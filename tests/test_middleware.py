@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_middleware
+---------------
+
+Tests for `cbh_core_model.middleware`.
+"""
+from django.test import RequestFactory, SimpleTestCase
+
+from cbh_core_model.middleware import UploadBackpressureMiddleware
+from cbh_core_model.uploads import UploadBackpressure, FLOWJS_RETRY_AFTER
+
+
+class TestUploadBackpressureMiddleware(SimpleTestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().post("/flow/upload")
+        self.middleware = UploadBackpressureMiddleware()
+
+    def test_backpressure_is_a_retryable_response(self):
+        response = self.middleware.process_exception(self.request, UploadBackpressure("Too busy", retry_after=7))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "7")
+        self.assertEqual(response.content, b"Too busy")
+
+    def test_default_retry_after(self):
+        response = self.middleware.process_exception(self.request, UploadBackpressure("Too busy"))
+        self.assertEqual(response["Retry-After"], str(FLOWJS_RETRY_AFTER))
+
+    def test_other_errors_are_left_alone(self):
+        self.assertIsNone(self.middleware.process_exception(self.request, ValueError("broken")))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_schema
+-----------
+
+Tests for building custom field configs from the schema of tabular data with `CustomFieldConfig.objects`.
+"""
+import io
+import unittest
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from cbh_core_model.models import CustomFieldConfig, PinnedCustomField
+from cbh_core_model.tabular import infer_schema, load_workbook
+
+
+def old_from_schema_lists(data, names, data_types, widths, name, creator):
+    """CustomFieldConfigManager.from_schema_lists as it was before bulk_create, one save per field and then the config"""
+    custom_field_config, created = CustomFieldConfig.objects.get_or_create(created_by=creator, name=name)
+    if created:
+        for colindex, pandas_dtype in enumerate(data_types):
+            pcf = PinnedCustomField()
+            pcf.field_type = pcf.pandas_converter(widths[colindex], pandas_dtype)
+            pcf.name = names[colindex]
+            pcf.position = colindex
+            pcf.custom_field_config = custom_field_config
+            #what pinned_custom_field.add(pcf) did before Django 1.9 refused unsaved objects
+            pcf.save()
+        custom_field_config.save()
+    return custom_field_config
+
+
+class SchemaTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username="schemer")
+
+    def fields(self, config):
+        """Every column of the fields of a config apart from the ones that differ between two configs"""
+        skipped = set(["id", "custom_field_config_id", "created", "modified"])
+        columns = [field.attname for field in PinnedCustomField._meta.concrete_fields if field.attname not in skipped]
+        return list(config.pinned_custom_field.order_by("position").values_list(*columns))
+
+
+class TestFromSchemaLists(SchemaTestCase):
+
+    names = ["Name", "Count", "Weight", "Notes", "Flag"]
+    data_types = ["object", "int64", "float64", "object", "bool"]
+    widths = [20, 5, 8, 250, 5]
+
+    def test_same_as_saving_each_field(self):
+        old = old_from_schema_lists(None, self.names, self.data_types, self.widths, "saved one by one", self.user)
+        new = CustomFieldConfig.objects.from_schema_lists(None, self.names, self.data_types, self.widths, "bulk", self.user)
+        self.assertEqual(list(new.pinned_custom_field.order_by("position").values_list("name", "position")),
+            list(zip(self.names, range(len(self.names)))))
+        self.assertEqual(self.fields(new), self.fields(old))
+        self.assertEqual(list(new.pinned_custom_field.order_by("position").values_list("field_type", flat=True)),
+            [PinnedCustomField.TEXT, PinnedCustomField.INTEGER, PinnedCustomField.NUMBER, PinnedCustomField.TEXTAREA,
+                PinnedCustomField.TEXT])
+
+    def test_existing_config_is_left_alone(self):
+        config = CustomFieldConfig.objects.from_schema_lists(None, self.names, self.data_types, self.widths, "bulk", self.user)
+        again = CustomFieldConfig.objects.from_schema_lists(None, ["Other"], ["object"], [10], "bulk", self.user)
+        self.assertEqual(again, config)
+        self.assertEqual(config.pinned_custom_field.count(), len(self.names))
+
+
+class TestFromSchemaStream(SchemaTestCase):
+    """The streamed schema should match inferring it from all of the rows held in memory"""
+
+    rows = [
+        ["Name", "Count", "Big", "Whole", "Weight", "Missing", "Notes"],
+        ["aspirin", 1, 2 ** 63, 1.0, 1.5, 3, "x" * 150],
+        ["ibuprofen", 22, 2 ** 64, 2.0, 2, None, "short"],
+        ["caffeine", 333, 5, 3.0, 7.25, 4, None],
+    ]
+
+    def in_memory(self, rows, name):
+        names, data_types, widths = infer_schema(list(rows))
+        return CustomFieldConfig.objects.from_schema_lists(None, names, data_types, widths, name, self.user)
+
+    def check(self, streamed, rows):
+        self.assertEqual(self.fields(streamed), self.fields(self.in_memory(rows, "in memory")))
+        return list(streamed.pinned_custom_field.order_by("position").values_list("name", "field_type"))
+
+    def test_csv(self):
+        text = "".join(",".join("" if value is None else str(value) for value in row) + "\n" for row in self.rows)
+        streamed = CustomFieldConfig.objects.from_schema_stream(io.BytesIO(text.encode("ascii")), "streamed", self.user,
+            extension=".csv")
+        rows = [[u"" if value is None else u"%s" % value for value in row] for row in self.rows]
+        self.assertEqual(self.check(streamed, rows), [("Name", PinnedCustomField.TEXT),
+            ("Count", PinnedCustomField.INTEGER), ("Big", PinnedCustomField.INTEGER), ("Whole", PinnedCustomField.NUMBER),
+            ("Weight", PinnedCustomField.NUMBER), ("Missing", PinnedCustomField.NUMBER),
+            ("Notes", PinnedCustomField.TEXTAREA)])
+
+    @unittest.skipIf(load_workbook is None, "openpyxl is not installed")
+    def test_workbook(self):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        for row in self.rows:
+            workbook.active.append(row)
+        saved = io.BytesIO()
+        workbook.save(saved)
+        saved.seek(0)
+        streamed = CustomFieldConfig.objects.from_schema_stream(saved, "streamed", self.user, extension=".xlsx")
+        #Cells come back as numbers, integer cells and whole floats make integer columns as they did when pandas read them
+        self.assertEqual(self.check(streamed, self.rows), [("Name", PinnedCustomField.TEXT),
+            ("Count", PinnedCustomField.INTEGER), ("Big", PinnedCustomField.INTEGER), ("Whole", PinnedCustomField.INTEGER),
+            ("Weight", PinnedCustomField.NUMBER), ("Missing", PinnedCustomField.NUMBER),
+            ("Notes", PinnedCustomField.TEXTAREA)])
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_tabular
+------------
+
+Tests for reading tabular uploads with `cbh_core_model.tabular`.
+"""
+import io
+import unittest
+
+from django.test import SimpleTestCase
+
+from cbh_core_model.tabular import (sniff_file_type, extract_preview, can_preview, load_workbook,
+    infer_schema, CSV, TSV, SDF, XLSX)
+
+
+SDF_RECORD = b"""mol
+  test
+
+  0  0  0  0  0  0            999 V2000
+M  END
+> <Name>
+Aspirin
+
+> <Weight>
+180.16
+
+$$$$
+"""
+
+
+class TestInferSchema(SimpleTestCase):
+
+    def infer(self, *rows, **kwargs):
+        return infer_schema([["column"]] + [[value] for value in rows], **kwargs)[1][0]
+
+    def test_integers(self):
+        self.assertEqual(self.infer("1", "22", " 3 "), "int64")
+        #Cell values from a workbook are already numbers
+        self.assertEqual(self.infer(1, 2 ** 70), "int64")
+
+    def test_missing_values_make_integers_floats(self):
+        self.assertEqual(self.infer("1", "", "NaN", None), "float64")
+
+    def test_floats(self):
+        self.assertEqual(self.infer("1", "2.5"), "float64")
+        self.assertEqual(self.infer(1.0, 2.0), "int64")
+        self.assertEqual(self.infer(1, 2.5), "float64")
+
+    def test_text(self):
+        self.assertEqual(self.infer("1", "abc"), "object")
+        self.assertEqual(self.infer(True, False), "object")
+
+    def test_empty_column(self):
+        self.assertEqual(self.infer("", None), "float64")
+
+    def test_names_and_widths(self):
+        names, data_types, widths = infer_schema([[" Name ", "Count"], ["aspirin", "1"], ["ibuprofen"]])
+        self.assertEqual(names, [u"Name", u"Count"])
+        #The short row counts as a missing count
+        self.assertEqual(data_types, ["object", "float64"])
+        self.assertEqual(widths, [9, 1])
+
+    def test_sample_size(self):
+        self.assertEqual(self.infer("1", "2", "abc", sample_size=2), "int64")
+        self.assertEqual(self.infer("1", "2", "abc"), "object")
+
+    def test_no_rows(self):
+        self.assertEqual(infer_schema([]), ([], [], []))
+
+
+class TestSniffFileType(SimpleTestCase):
+
+    def test_csv(self):
+        self.assertEqual(sniff_file_type(b"a,b,c\n1,2,3\n", ".csv"), CSV)
+
+    def test_tsv_from_extension(self):
+        self.assertEqual(sniff_file_type(b"a,b\n", ".tsv"), TSV)
+
+    def test_tsv_from_content(self):
+        self.assertEqual(sniff_file_type(b"a\tb\tc\n1\t2\t3\n", ".txt"), TSV)
+
+    def test_sdf_from_content(self):
+        self.assertEqual(sniff_file_type(SDF_RECORD, ".txt"), SDF)
+
+    def test_xlsx_from_zip_header(self):
+        self.assertEqual(sniff_file_type(b"PK\x03\x04rest", ".xlsx"), XLSX)
+
+    def test_can_preview(self):
+        for extension in (".csv", ".CSV", ".tsv", ".sdf", ".xlsx"):
+            self.assertTrue(can_preview(extension))
+        for extension in (".png", ".pdf", ".docx", "", None):
+            self.assertFalse(can_preview(extension))
+
+
+class TestExtractPreview(SimpleTestCase):
+
+    def test_csv_whole_file(self):
+        data = b"name,value\na,1\nb,2\nc,3\n"
+        preview = extract_preview(io.BytesIO(data), ".csv", len(data), max_rows=2)
+        self.assertEqual(preview["file_type"], CSV)
+        self.assertEqual(preview["headers"], [u"name", u"value"])
+        self.assertEqual(preview["rows"], [[u"a", u"1"], [u"b", u"2"]])
+        self.assertEqual(preview["estimated_row_count"], 3)
+
+    def test_csv_partial_read_estimates_rows(self):
+        data = ("name,value\n" + "".join("row%03d,1\n" % number for number in range(100))).encode("ascii")
+        preview = extract_preview(io.BytesIO(data), ".csv", len(data), max_rows=3, head_bytes=200)
+        self.assertEqual(len(preview["rows"]), 3)
+        #The cut off line at the end of the read is not returned
+        self.assertTrue(all(len(row) == 2 for row in preview["rows"]))
+        self.assertTrue(80 <= preview["estimated_row_count"] <= 120)
+
+    def test_tsv(self):
+        data = b"name\tvalue\na\t1\n"
+        preview = extract_preview(io.BytesIO(data), ".tsv", len(data))
+        self.assertEqual(preview["file_type"], TSV)
+        self.assertEqual(preview["headers"], [u"name", u"value"])
+        self.assertEqual(preview["rows"], [[u"a", u"1"]])
+
+    def test_sdf(self):
+        data = SDF_RECORD * 3
+        preview = extract_preview(io.BytesIO(data), ".sdf", len(data), max_rows=2)
+        self.assertEqual(preview["file_type"], SDF)
+        self.assertEqual(preview["headers"], [u"Name", u"Weight"])
+        self.assertEqual(preview["rows"], [[u"Aspirin", u"180.16"], [u"Aspirin", u"180.16"]])
+        self.assertEqual(preview["estimated_row_count"], 3)
+
+    @unittest.skipIf(load_workbook is None, "openpyxl is not installed")
+    def test_xlsx(self):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(["name", "value"])
+        for number in range(5):
+            sheet.append(["row%d" % number, number])
+        data = io.BytesIO()
+        workbook.save(data)
+        data.seek(0)
+        preview = extract_preview(data, ".xlsx", len(data.getvalue()), max_rows=2)
+        self.assertEqual(preview["file_type"], XLSX)
+        self.assertEqual(preview["headers"], [u"name", u"value"])
+        self.assertEqual(preview["rows"], [[u"row0", u"0"], [u"row1", u"1"]])
+        self.assertEqual(preview["estimated_row_count"], 5)
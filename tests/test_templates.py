@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_templates
+--------------
+
+Tests for the cached custom field config templates used when creating projects.
+"""
+from django.contrib.auth.models import Permission, User
+from django.core.cache import cache
+from django.test import TestCase
+
+from cbh_core_model.models import (CustomFieldConfig, DataType, PinnedCustomField, Project, ProjectType,
+    get_name_for_custom_field_config_from_project)
+
+
+class TemplateTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="templater")
+        self.template = self.create_template("template", ["Name", "Weight"])
+
+    def create_template(self, name, field_names):
+        config = CustomFieldConfig.objects.create(name=name, created_by=self.user)
+        PinnedCustomField.objects.bulk_create([PinnedCustomField(custom_field_config=config, name=field_name,
+            position=position, field_type=PinnedCustomField.TEXT) for position, field_name in enumerate(field_names)])
+        return config
+
+    def field_names(self, template_id):
+        return [pcf.name for pcf in CustomFieldConfig.objects.get_template(template_id)[1]]
+
+
+class TestTemplateCache(TemplateTestCase):
+
+    def test_cached_after_first_load(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.field_names(self.template.pk), ["Name", "Weight"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.field_names(self.template.pk), ["Name", "Weight"])
+
+    def test_saving_a_field_invalidates(self):
+        self.field_names(self.template.pk)
+        pcf = PinnedCustomField.objects.get(custom_field_config=self.template, name="Weight")
+        pcf.name = "Mass"
+        pcf.save()
+        self.assertEqual(self.field_names(self.template.pk), ["Name", "Mass"])
+
+    def test_queryset_update_invalidates(self):
+        self.field_names(self.template.pk)
+        PinnedCustomField.objects.filter(custom_field_config=self.template, name="Weight").update(name="Mass")
+        self.assertEqual(self.field_names(self.template.pk), ["Name", "Mass"])
+
+    def test_bulk_create_invalidates(self):
+        self.field_names(self.template.pk)
+        PinnedCustomField.objects.bulk_create([PinnedCustomField(custom_field_config=self.template, name="Purity",
+            position=2, field_type=PinnedCustomField.TEXT)])
+        self.assertEqual(self.field_names(self.template.pk), ["Name", "Weight", "Purity"])
+
+    def test_templates_load_together(self):
+        other = self.create_template("other", ["Colour"])
+        empty = self.create_template("empty", [])
+        with self.assertNumQueries(2):
+            templates = CustomFieldConfig.objects.get_templates([self.template.pk, other.pk, empty.pk, -1])
+        self.assertEqual(sorted(templates), sorted([self.template.pk, other.pk, empty.pk]))
+        self.assertEqual(templates[empty.pk], (empty, []))
+
+    def test_missing_template(self):
+        with self.assertRaises(CustomFieldConfig.DoesNotExist):
+            CustomFieldConfig.objects.get_template(-1)
+
+
+class TestBulkProvisionTemplates(TemplateTestCase):
+
+    def test_dangling_template_is_skipped(self):
+        with_template, dangling = Project.objects.bulk_provision([
+            {"name": "With template", "created_by": self.user, "custom_field_config_template": self.template},
+            {"name": "Dangling", "created_by": self.user, "custom_field_config_template": -1},
+        ])
+        self.assertEqual(list(with_template.custom_field_config.pinned_custom_field.order_by("position")
+            .values_list("name", flat=True)), ["Name", "Weight"])
+        self.assertFalse(dangling.custom_field_config.pinned_custom_field.exists())
+
+
+class TestBulkProvisionMatchesCreate(TemplateTestCase):
+    """bulk_provision skips the save signals, so check it leaves the same rows behind as creating a project one by one"""
+
+    def describe(self, project):
+        """Everything about a project that should not depend on how it was created, with its id and name taken out"""
+        def plain(text):
+            return text.replace(str(project.pk), "<id>").replace(project.name, "<name>")
+        project = Project.objects.get(pk=project.pk)
+        permissions = Permission.objects.filter(codename__startswith="%d__" % project.pk)
+        return {
+            "project": (project.project_key == project.name.lower().replace(" ", "-"), project.project_type_id,
+                project.project_counter_start, project.created_by_id),
+            "config": (plain(project.custom_field_config.name), project.custom_field_config.created_by_id,
+                project.custom_field_config.schemaform, project.custom_field_config.data_type_id),
+            "fields": list(project.custom_field_config.pinned_custom_field.order_by("position")
+                .values_list("name", "position", "field_type", "required")),
+            "permissions": sorted((plain(permission.codename), plain(permission.name), permission.content_type_id)
+                for permission in permissions),
+            "owner": sorted(plain(codename) for codename in 
+                self.user.user_permissions.filter(pk__in=permissions).values_list("codename", flat=True)),
+        }
+
+    def test_same_as_create(self):
+        data_type = DataType.objects.create(name="Compound")
+        CustomFieldConfig.objects.filter(pk=self.template.pk).update(schemaform='{"form": []}', data_type=data_type)
+        project_type = ProjectType.objects.create(name="Compounds", custom_field_config_template_id=self.template.pk)
+        created = Project.objects.create(name="Created One", created_by=self.user, project_type=project_type)
+        created.custom_field_config = CustomFieldConfig.objects.clone_template(self.template.pk, 
+            get_name_for_custom_field_config_from_project(created), self.user)
+        created.save()
+        provisioned, = Project.objects.bulk_provision([{"name": "Provisioned One", "created_by": self.user, 
+            "project_type": project_type}])
+        expected = self.describe(created)
+        self.assertEqual(len(expected["permissions"]), 3)
+        self.assertEqual(expected["owner"], ["<id>__owner"])
+        self.assertEqual(expected["config"][2:], ('{"form": []}', data_type.pk))
+        self.assertEqual(self.describe(provisioned), expected)
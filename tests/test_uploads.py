@@ -0,0 +1,749 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_uploads
+------------
+
+Tests for joining upload chunks through the `cbh_core_model.uploads` storage composers.
+"""
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+
+import mock
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage, Storage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from cbh_core_model.models import CBHFlowFile, CBHFlowFileChunk, CBHFlowFilePreview, Project, build_flow_file_preview
+from cbh_core_model.metrics import InMemoryCollector, CHUNK_WRITE
+from cbh_core_model.tabular import iter_xlsx_rows, load_workbook
+from cbh_core_model.uploads import (get_composer, move_stored_file, LocalComposer, ObjectStoreComposer, ChunkIngestionPool, DetachedChunk, 
+    UploadBackpressure, PipelineCounters, CompressingWriter, DecompressingFile, default_compression, zstandard, GZIP, ZSTD)
+
+
+class DirectoryObjectStorage(Storage):
+    """Stand-in for an object store kept in a local directory, it has no local paths
+    and concatenates objects itself when asked to compose them"""
+
+    def __init__(self, location):
+        self.location = location
+        self.composed = []
+
+    def _full_path(self, name):
+        return os.path.join(self.location, name)
+
+    def _open(self, name, mode="rb"):
+        return File(open(self._full_path(name), mode))
+
+    def _save(self, name, content):
+        full_path = self._full_path(name)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, "wb") as stored:
+            for data in content.chunks():
+                stored.write(data)
+        return name
+
+    def exists(self, name):
+        return os.path.exists(self._full_path(name))
+
+    def delete(self, name):
+        if self.exists(name):
+            os.remove(self._full_path(name))
+
+    def size(self, name):
+        return os.path.getsize(self._full_path(name))
+
+    def compose(self, names, target):
+        self.composed.append((names, target))
+        with open(self._full_path(target), "wb") as stored:
+            for name in names:
+                with open(self._full_path(name), "rb") as source:
+                    shutil.copyfileobj(source, stored)
+
+
+class TestComposers(SimpleTestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.chunks = [b"first chunk,", b"second chunk,", b"last chunk"]
+        self.names = ["chunks/upload-%d.tmp" % (number + 1) for number in range(len(self.chunks))]
+
+    def save_chunks(self, storage):
+        for name, data in zip(self.names, self.chunks):
+            storage.save(name, ContentFile(data))
+
+    def read(self, storage, name):
+        with storage.open(name) as stored:
+            return stored.read()
+
+    def test_get_composer(self):
+        self.assertIsInstance(get_composer(FileSystemStorage(location=self.location)), LocalComposer)
+        self.assertIsInstance(get_composer(DirectoryObjectStorage(self.location)), ObjectStoreComposer)
+
+    def test_local_compose(self):
+        storage = FileSystemStorage(location=self.location)
+        self.save_chunks(storage)
+        size = LocalComposer(storage).compose(self.names, "joined.csv")
+        self.assertEqual(self.read(storage, "joined.csv"), b"".join(self.chunks))
+        self.assertEqual(size, len(b"".join(self.chunks)))
+
+    def test_local_compose_hashes_data(self):
+        storage = FileSystemStorage(location=self.location)
+        self.save_chunks(storage)
+        digest = hashlib.sha256()
+        LocalComposer(storage).compose(self.names, "joined.csv", digest=digest)
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(b"".join(self.chunks)).hexdigest())
+
+    def test_object_store_composes_on_server(self):
+        storage = DirectoryObjectStorage(self.location)
+        self.save_chunks(storage)
+        ObjectStoreComposer(storage).compose(self.names, "joined.csv")
+        self.assertEqual(storage.composed, [(self.names, "joined.csv")])
+        self.assertEqual(self.read(storage, "joined.csv"), b"".join(self.chunks))
+
+    def test_object_store_streams_when_hashing(self):
+        storage = DirectoryObjectStorage(self.location)
+        self.save_chunks(storage)
+        digest = hashlib.sha256()
+        ObjectStoreComposer(storage).compose(self.names, "joined.csv", digest=digest)
+        self.assertEqual(storage.composed, [])
+        self.assertEqual(self.read(storage, "joined.csv"), b"".join(self.chunks))
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(b"".join(self.chunks)).hexdigest())
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+
+class TestPreviewReceiver(SimpleTestCase):
+
+    def test_skips_uploads_that_are_not_tables(self):
+        with mock.patch.object(CBHFlowFilePreview.objects, "build_for") as build_for:
+            build_flow_file_preview(CBHFlowFile, CBHFlowFile(identifier="photo", original_filename="photo.png"))
+        self.assertFalse(build_for.called)
+
+    def test_logs_files_that_cannot_be_read(self):
+        with mock.patch.object(CBHFlowFilePreview.objects, "build_for", side_effect=ValueError("line contains NUL")) as build_for:
+            build_flow_file_preview(CBHFlowFile, CBHFlowFile(identifier="broken", original_filename="broken.csv"))
+        self.assertTrue(build_for.called)
+
+
+class RecordingAssemblyBackend(object):
+    """Assembly backend that only records the jobs it is given"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, func, *args):
+        self.jobs.append((func, args))
+
+
+class FlowFileTestMixin(object):
+    """Creates a project to attach uploads to and keeps stored files in a temporary media root"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create(username="uploader")
+        self.project = Project.objects.create(name="Uploads", created_by=self.user)
+
+    def create_flow_file(self, identifier="upload", total_chunks=3, **kwargs):
+        return CBHFlowFile.objects.create(identifier=identifier, original_filename="%s.csv" % identifier, 
+            total_chunks=total_chunks, project=self.project, **kwargs)
+
+    def upload(self, identifier, chunks):
+        """Upload and assemble a file from a list of byte string chunks"""
+        flow_file = self.create_flow_file(identifier, total_chunks=len(chunks))
+        for number, data in enumerate(chunks, 1):
+            flow_file.receive_chunk(number, data)
+        #on_commit callbacks do not run inside a test case so the assembly is run here
+        self.assertEqual(flow_file.state, CBHFlowFile.STATE_ASSEMBLING)
+        flow_file.join_chunks()
+        return flow_file
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+
+class FlowFileTestCase(FlowFileTestMixin, TestCase):
+    pass
+
+
+class TestReceivedChunks(FlowFileTestCase):
+
+    def create_legacy(self, numbers, total_chunks_uploaded):
+        """An upload from before the received chunks bitmap, which counted every chunk row including duplicates"""
+        flow_file = self.create_flow_file("legacy", total_chunks=3, total_chunks_uploaded=total_chunks_uploaded)
+        CBHFlowFile.objects.filter(pk=flow_file.pk).update(received_chunks=b"")
+        CBHFlowFileChunk.objects.bulk_create([CBHFlowFileChunk(parent=flow_file, number=number, 
+            file=flow_file.get_chunk_filename(number)) for number in numbers])
+        return CBHFlowFile.objects.get(pk=flow_file.pk)
+
+    def test_duplicate_chunks_are_counted_once(self):
+        flow_file = self.create_flow_file(total_chunks=3)
+        self.assertEqual(flow_file.receive_chunk(1, b"a"), 1)
+        self.assertEqual(flow_file.receive_chunk(1, b"a"), 1)
+        self.assertEqual(flow_file.missing_chunks(), [2, 3])
+        self.assertEqual(flow_file.state, CBHFlowFile.STATE_UPLOADING)
+
+    def test_chunk_sent_again_is_joined_once(self):
+        flow_file = self.create_flow_file(total_chunks=3)
+        for number, data in ((1, b"a,b\n"), (2, b"1,2\n"), (2, b"1,2\n"), (3, b"3,4\n")):
+            flow_file.receive_chunk(number, data)
+        self.assertEqual(flow_file.chunks.count(), 4)
+        flow_file.join_chunks()
+        with flow_file.file as stored:
+            self.assertEqual(stored.read(), b"a,b\n1,2\n3,4\n")
+
+    def test_chunk_outside_the_upload_is_rejected(self):
+        flow_file = self.create_flow_file(total_chunks=3)
+        with self.assertRaises(ValueError):
+            flow_file.mark_chunk_received(4)
+        self.assertEqual(CBHFlowFile.objects.get(pk=flow_file.pk).total_chunks_uploaded, 0)
+
+    def test_legacy_missing_chunks_come_from_the_chunk_rows(self):
+        flow_file = self.create_legacy([1, 1, 2], total_chunks_uploaded=3)
+        self.assertEqual(flow_file.missing_chunks(), [3])
+        self.assertEqual(CBHFlowFile.objects.get(pk=flow_file.pk).total_chunks_uploaded, 2)
+
+    def test_legacy_upload_completes_on_the_last_chunk(self):
+        flow_file = self.create_legacy([1, 1, 2], total_chunks_uploaded=3)
+        self.assertEqual(flow_file.receive_chunk(2, b"b"), 2)
+        self.assertEqual(flow_file.state, CBHFlowFile.STATE_UPLOADING)
+        self.assertEqual(flow_file.receive_chunk(3, b"c"), 3)
+        self.assertEqual(flow_file.state, CBHFlowFile.STATE_ASSEMBLING)
+
+
+class TestChunkWriteMetrics(FlowFileTestCase):
+
+    def test_storage_write_is_timed(self):
+        collector = InMemoryCollector()
+        flow_file = self.create_flow_file(total_chunks=2)
+        with mock.patch("cbh_core_model.metrics._collector", collector), \
+                mock.patch.object(FileSystemStorage, "size", side_effect=AssertionError("size asked of the storage")):
+            flow_file.receive_chunk(1, b"a,b\n")
+            flow_file.receive_chunk(2, SimpleUploadedFile("blob", b"1,2,3\n"))
+        self.assertEqual(collector.stats()["stages"][CHUNK_WRITE]["count"], 2)
+        self.assertEqual(collector.stats()["stages"][CHUNK_WRITE]["bytes"], 10)
+        self.assertEqual([chunk.file.name for chunk in flow_file.chunks.all()],
+            [chunk.file.field.generate_filename(chunk, chunk.filename) for chunk in flow_file.chunks.all()])
+
+
+class TestWriteInPlace(FlowFileTestCase):
+
+    def create_in_place(self, chunks, chunk_size):
+        return self.create_flow_file("in-place", total_chunks=len(chunks), write_in_place=True, chunk_size=chunk_size,
+            total_size=sum(len(data) for data in chunks))
+
+    def test_chunks_written_out_of_order(self):
+        chunks = [b"aaaa", b"bbbb", b"cc"]
+        flow_file = self.create_in_place(chunks, chunk_size=4)
+        for number in (3, 1, 2):
+            flow_file.receive_chunk(number, chunks[number - 1])
+        self.assertEqual(flow_file.state, CBHFlowFile.STATE_ASSEMBLING)
+        flow_file.join_chunks()
+        with default_storage.open(flow_file.path) as assembled:
+            self.assertEqual(assembled.read(), b"aaaabbbbcc")
+
+    def test_chunk_size_is_needed_for_several_chunks(self):
+        with self.assertRaises(ValueError):
+            self.create_in_place([b"aaaa", b"bb"], chunk_size=0)
+        self.assertEqual(self.create_in_place([b"aaaa"], chunk_size=0).total_chunks, 1)
+
+    def test_chunk_outside_the_upload_is_not_written(self):
+        flow_file = self.create_in_place([b"aaaa", b"bb"], chunk_size=4)
+        with self.assertRaises(ValueError):
+            flow_file.receive_chunk(3, b"cccc")
+        self.assertEqual(default_storage.size(flow_file.path), 6)
+
+
+class TestClaimCompletion(FlowFileTestCase):
+
+    def test_exactly_one_claim_succeeds(self):
+        flow_file = self.create_flow_file(total_chunks=2)
+        CBHFlowFile.objects.filter(pk=flow_file.pk).update(total_chunks_uploaded=2)
+        #Two workers that each counted the last chunk hold their own copy of the row
+        first, second = CBHFlowFile.objects.get(pk=flow_file.pk), CBHFlowFile.objects.get(pk=flow_file.pk)
+        claims = [first.claim_completion(CBHFlowFile.STATE_ASSEMBLING), second.claim_completion(CBHFlowFile.STATE_ASSEMBLING)]
+        self.assertEqual(claims, [True, False])
+        self.assertEqual(first.state, CBHFlowFile.STATE_ASSEMBLING)
+        self.assertEqual(second.state, CBHFlowFile.STATE_UPLOADING)
+        self.assertEqual(CBHFlowFile.objects.get(pk=flow_file.pk).state, CBHFlowFile.STATE_ASSEMBLING)
+
+    def test_no_claim_before_every_chunk_is_counted(self):
+        flow_file = self.create_flow_file(total_chunks=2)
+        flow_file.receive_chunk(1, b"a,b\n")
+        self.assertFalse(flow_file.claim_completion(CBHFlowFile.STATE_ASSEMBLING))
+        self.assertEqual(CBHFlowFile.objects.get(pk=flow_file.pk).state, CBHFlowFile.STATE_UPLOADING)
+
+
+class TestStuckAssemblies(FlowFileTestCase):
+
+    def create_assembling(self, identifier, minutes_ago):
+        flow_file = self.create_flow_file(identifier)
+        CBHFlowFile.objects.filter(pk=flow_file.pk).update(state=CBHFlowFile.STATE_ASSEMBLING, 
+            assembly_started=timezone.now() - timedelta(minutes=minutes_ago))
+        return flow_file
+
+    def test_only_old_assemblies_are_stuck(self):
+        stuck = self.create_assembling("stuck", 120)
+        self.create_assembling("running", 1)
+        self.assertEqual(list(CBHFlowFile.objects.stuck_assemblies(timedelta(minutes=30))), [stuck])
+        self.assertEqual(CBHFlowFile.objects.active_assemblies().count(), 1)
+
+    def test_requeue(self):
+        stuck = self.create_assembling("stuck", 120)
+        backend = RecordingAssemblyBackend()
+        self.assertEqual(CBHFlowFile.objects.recover_assemblies(timedelta(minutes=30), backend=backend), 1)
+        self.assertEqual([args for func, args in backend.jobs], [(stuck.pk,)])
+        #The assembly timer restarts so the upload is not recovered twice
+        self.assertEqual(CBHFlowFile.objects.recover_assemblies(timedelta(minutes=30), backend=backend), 0)
+
+    def test_fail(self):
+        stuck = self.create_assembling("stuck", 120)
+        self.assertEqual(CBHFlowFile.objects.recover_assemblies(timedelta(minutes=30), requeue=False), 1)
+        self.assertEqual(CBHFlowFile.objects.get(pk=stuck.pk).state, CBHFlowFile.STATE_UPLOAD_ERROR)
+
+    def test_stuck_assemblies_are_collected(self):
+        stuck = self.create_assembling("stuck", 5)
+        CBHFlowFile.objects.filter(pk=stuck.pk).update(created=timezone.now() - timedelta(hours=2))
+        self.assertEqual(CBHFlowFile.objects.collect_stale(timedelta(hours=1), dry_run=True)[0], 0)
+        CBHFlowFile.objects.filter(pk=stuck.pk).update(assembly_started=timezone.now() - timedelta(hours=2))
+        self.assertEqual(CBHFlowFile.objects.collect_stale(timedelta(hours=1))[0], 1)
+        self.assertFalse(CBHFlowFile.objects.filter(pk=stuck.pk).exists())
+
+
+class TestDeleteChunks(FlowFileTestCase):
+
+    def receive(self, identifier):
+        flow_file = self.create_flow_file(identifier, total_chunks=3)
+        flow_file.receive_chunk(1, b"a,b\n")
+        flow_file.receive_chunk(2, b"1,2\n")
+        return flow_file, list(flow_file.chunks.values_list("file", flat=True))
+
+    def check_deleted(self, flow_file, names):
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(default_storage.exists(name) for name in names))
+        flow_file.delete_chunks()
+        self.assertFalse(CBHFlowFileChunk.objects.filter(parent=flow_file).exists())
+        self.assertFalse(any(default_storage.exists(name) for name in names))
+
+    def test_rows_and_files_are_removed(self):
+        self.check_deleted(*self.receive("flat"))
+
+    def test_files_are_removed_when_removing_files_on_delete_is_off(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_REMOVE_FILES_ON_DELETE", False):
+            self.check_deleted(*self.receive("kept"))
+
+    def test_sharded_chunk_directory_is_removed(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_SHARDED_LAYOUT", True):
+            flow_file, names = self.receive("sharded")
+        self.check_deleted(flow_file, names)
+        self.assertFalse(os.path.exists(default_storage.path(flow_file.chunk_directory)))
+
+    def test_other_uploads_keep_their_chunks(self):
+        flow_file, names = self.receive("first")
+        other, other_names = self.receive("second")
+        self.check_deleted(flow_file, names)
+        self.assertEqual(other.chunks.count(), 2)
+        self.assertTrue(all(default_storage.exists(name) for name in other_names))
+
+
+class TestCapacity(FlowFileTestCase):
+
+    def setUp(self):
+        super(TestCapacity, self).setUp()
+        self.other_project = Project.objects.create(name="Other uploads", created_by=self.user)
+        self.counters = PipelineCounters()
+        patcher = mock.patch("cbh_core_model.models.pipeline_counters", self.counters)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_limit_per_project(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_MAX_ACTIVE_UPLOADS_PER_PROJECT", 1):
+            self.create_flow_file("first")
+            with self.assertRaises(UploadBackpressure):
+                self.create_flow_file("second")
+            CBHFlowFile.objects.create(identifier="elsewhere", original_filename="elsewhere.csv", total_chunks=1,
+                project=self.other_project)
+        self.assertEqual(self.counters.stats()["rejected"], {"project_uploads": 1})
+        self.assertFalse(CBHFlowFile.objects.filter(identifier="second").exists())
+
+    def test_limit_across_projects(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_MAX_ACTIVE_UPLOADS", 2):
+            self.create_flow_file("first")
+            CBHFlowFile.objects.create(identifier="elsewhere", original_filename="elsewhere.csv", total_chunks=1,
+                project=self.other_project)
+            with self.assertRaises(UploadBackpressure):
+                self.create_flow_file("third")
+        self.assertEqual(self.counters.stats()["rejected"], {"uploads": 1})
+
+    def test_old_and_finished_uploads_do_not_count(self):
+        old = self.create_flow_file("old")
+        CBHFlowFile.objects.filter(pk=old.pk).update(created=timezone.now() - timedelta(days=1))
+        CBHFlowFile.objects.filter(pk=self.create_flow_file("done").pk).update(state=CBHFlowFile.STATE_COMPLETED)
+        with mock.patch("cbh_core_model.models.FLOWJS_MAX_ACTIVE_UPLOADS", 1):
+            self.create_flow_file("new")
+
+    def test_limit_on_assemblies(self):
+        CBHFlowFile.objects.filter(pk=self.create_flow_file("first").pk).update(state=CBHFlowFile.STATE_ASSEMBLING,
+            assembly_started=timezone.now())
+        with mock.patch("cbh_core_model.models.FLOWJS_MAX_ACTIVE_ASSEMBLIES", 1):
+            with self.assertRaises(UploadBackpressure):
+                self.create_flow_file("second")
+        self.assertEqual(self.counters.stats()["rejected"], {"assemblies": 1})
+
+    def test_pipeline_stats(self):
+        self.create_flow_file("first")
+        self.create_flow_file("second")
+        CBHFlowFile.objects.create(identifier="elsewhere", original_filename="elsewhere.csv", total_chunks=1,
+            project=self.other_project)
+        CBHFlowFile.objects.filter(pk=self.create_flow_file("assembling").pk).update(state=CBHFlowFile.STATE_ASSEMBLING,
+            assembly_started=timezone.now())
+        CBHFlowFile.objects.filter(pk=self.create_flow_file("stuck").pk).update(state=CBHFlowFile.STATE_ASSEMBLING,
+            assembly_started=timezone.now() - timedelta(days=1))
+        self.counters.reject("uploads")
+        stats = CBHFlowFile.objects.pipeline_stats()
+        self.assertEqual(stats["active_uploads"], 3)
+        self.assertEqual(stats["active_uploads_by_project"], {self.project.pk: 2, self.other_project.pk: 1})
+        self.assertEqual(stats["assembling"], 1)
+        self.assertEqual(stats["stuck_assemblies"], 1)
+        self.assertEqual(stats["rejected"], {"uploads": 1})
+        self.assertIn("queue_depth", stats["assembly_backend"])
+
+
+class TestCollectStale(FlowFileTestMixin, TransactionTestCase):
+    """Runs outside a test transaction so that the files removed on commit are removed"""
+
+    def create_stale(self):
+        flow_file = self.create_flow_file("stale", total_chunks=3)
+        flow_file.receive_chunk(1, b"a,b\n")
+        CBHFlowFilePreview.objects.create(flow_file=flow_file, file_type="csv")
+        CBHFlowFile.objects.filter(pk=flow_file.pk).update(created=timezone.now() - timedelta(hours=2))
+        return flow_file, flow_file.chunks.get().file.name
+
+    def test_rows_and_files_are_removed(self):
+        flow_file, chunk_name = self.create_stale()
+        self.assertEqual(CBHFlowFile.objects.collect_stale(timedelta(hours=1)), (1, 4))
+        self.assertFalse(CBHFlowFile.objects.filter(pk=flow_file.pk).exists())
+        self.assertFalse(CBHFlowFilePreview.objects.exists())
+        self.assertFalse(default_storage.exists(chunk_name))
+
+    def test_files_are_kept_when_the_transaction_rolls_back(self):
+        flow_file, chunk_name = self.create_stale()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                CBHFlowFile.objects.collect_stale(timedelta(hours=1))
+                raise RuntimeError
+        self.assertTrue(CBHFlowFile.objects.filter(pk=flow_file.pk).exists())
+        self.assertTrue(default_storage.exists(chunk_name))
+
+    def test_shared_content_is_kept(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_DEDUPLICATE_UPLOADS", True):
+            completed = self.upload("completed", [b"a,b\n"])
+        flow_file, chunk_name = self.create_stale()
+        #An assembly that stored its content in the shared copy and then got stuck
+        CBHFlowFile.objects.filter(pk=flow_file.pk).update(state=CBHFlowFile.STATE_ASSEMBLING, sha256=completed.sha256,
+            storage_path=completed.storage_path, assembly_started=timezone.now() - timedelta(hours=2))
+        with mock.patch("cbh_core_model.models.FLOWJS_REMOVE_FILES_ON_DELETE", False):
+            self.assertEqual(CBHFlowFile.objects.collect_stale(timedelta(hours=1)), (1, 4))
+        self.assertFalse(default_storage.exists(chunk_name))
+        with completed.file as stored:
+            self.assertEqual(stored.read(), b"a,b\n")
+
+
+class TestMoveStoredFile(SimpleTestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def check_move(self, storage):
+        storage.save("old/file.csv", ContentFile(b"a,b\n"))
+        self.assertEqual(move_stored_file(storage, "old/file.csv", "new/file.csv"), "new/file.csv")
+        self.assertFalse(storage.exists("old/file.csv"))
+        with storage.open("new/file.csv") as moved:
+            self.assertEqual(moved.read(), b"a,b\n")
+        self.assertFalse(move_stored_file(storage, "old/file.csv", "new/file.csv"))
+
+    def test_local_storage(self):
+        self.check_move(FileSystemStorage(location=self.location))
+
+    def test_storage_without_local_paths(self):
+        self.check_move(DirectoryObjectStorage(self.location))
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+
+class TestLayout(FlowFileTestCase):
+
+    def test_layout_is_kept_with_the_upload(self):
+        with mock.patch("cbh_core_model.models.FLOWJS_SHARDED_LAYOUT", True):
+            flow_file = self.create_flow_file("sharded", total_chunks=2)
+            flow_file.receive_chunk(1, b"a,b\n")
+        chunk_name = flow_file.chunks.get().file.name
+        self.assertTrue(chunk_name.startswith(flow_file.chunk_directory))
+        #Turning the setting off afterwards does not move the upload
+        flow_file = CBHFlowFile.objects.get(pk=flow_file.pk)
+        self.assertEqual(flow_file.path, flow_file.get_layout_path(True))
+        flow_file.receive_chunk(2, b"1,2\n")
+        flow_file.join_chunks()
+        self.assertTrue(default_storage.exists(flow_file.get_layout_path(True)))
+
+    def test_relayout(self):
+        flow_file = self.create_flow_file("flat", total_chunks=2)
+        flow_file.receive_chunk(1, b"a,b\n")
+        default_storage.save(flow_file.path, ContentFile(b"partial"))
+        with mock.patch("cbh_core_model.management.commands.relayout_flowfiles.FLOWJS_SHARDED_LAYOUT", True):
+            call_command("relayout_flowfiles", stdout=StringIO())
+        flow_file = CBHFlowFile.objects.get(pk=flow_file.pk)
+        self.assertTrue(flow_file.sharded_layout)
+        self.assertTrue(default_storage.exists(flow_file.get_layout_path(True)))
+        self.assertFalse(default_storage.exists(flow_file.get_layout_path(False)))
+        chunk_name = flow_file.chunks.get().file.name
+        self.assertTrue(chunk_name.startswith(flow_file.chunk_directory))
+        self.assertTrue(default_storage.exists(chunk_name))
+
+
+class TestReadRange(FlowFileTestCase):
+
+    data = b"name,value\na,1\nb,2\n"
+
+    def upload_sized(self, identifier):
+        flow_file = self.upload(identifier, [self.data[:10], self.data[10:]])
+        flow_file.total_size = len(self.data)
+        return flow_file
+
+    def test_read_through_a_memory_map(self):
+        flow_file = self.upload_sized("plain")
+        with mock.patch.object(CBHFlowFile, "open_mmap", autospec=True, side_effect=CBHFlowFile.open_mmap) as open_mmap:
+            self.assertEqual(flow_file.read_range(11, 3), b"a,1")
+        self.assertTrue(open_mmap.called)
+        with flow_file.mapped_range(11, 3) as view:
+            self.assertEqual(view[:], b"a,1")
+
+    def test_compressed_upload_is_read_through_the_file(self):
+        with mock.patch("cbh_core_model.uploads.FLOWJS_COMPRESS_UPLOADS", True):
+            flow_file = self.upload_sized("packed")
+        self.assertTrue(flow_file.compression)
+        self.assertEqual(flow_file.read_range(11, 3), b"a,1")
+        with self.assertRaises(ValueError):
+            with flow_file.mapped_range(11, 3):
+                pass
+
+    def test_full_path_of_compressed_upload(self):
+        with mock.patch("cbh_core_model.uploads.FLOWJS_COMPRESS_UPLOADS", True):
+            flow_file = self.upload_sized("packed")
+        with mock.patch("cbh_core_model.models.FLOWJS_DECOMPRESSED_DIR", os.path.join(self.media_root, "decompressed")):
+            path = flow_file.full_path
+            self.assertEqual(path, flow_file.decompressed_path)
+            with io.open(path, "rb") as decompressed:
+                self.assertEqual(decompressed.read(), self.data)
+            with mock.patch("cbh_core_model.models.decompress_to_path") as decompress:
+                self.assertEqual(flow_file.full_path, path)
+            self.assertFalse(decompress.called)
+
+    def test_range_past_the_end(self):
+        flow_file = self.upload_sized("plain")
+        self.assertEqual(flow_file.read_range(15, 100), b"b,2\n")
+        self.assertEqual(flow_file.read_range(100, 5), b"")
+        with self.assertRaises(ValueError):
+            flow_file.read_range(-1, 5)
+
+    def test_upload_that_has_not_completed(self):
+        flow_file = self.create_flow_file(total_chunks=2, total_size=len(self.data))
+        with self.assertRaises(ValueError):
+            flow_file.read_range(0, 5)
+
+
+class TestDecompressingFile(SimpleTestCase):
+
+    data = "".join("line %04d\n" % number for number in range(2000)).encode("ascii")
+
+    def open(self, compression=GZIP, size=None):
+        compressed = io.BytesIO()
+        writer = CompressingWriter(compressed, compression)
+        writer.write(self.data)
+        writer.close()
+        return DecompressingFile(io.BytesIO(compressed.getvalue()), compression, size=size)
+
+    def check_seeks(self, stored):
+        stored.seek(100)
+        self.assertEqual(stored.read(10), self.data[100:110])
+        stored.seek(5)
+        self.assertEqual(stored.read(10), self.data[5:15])
+        stored.seek(-10, os.SEEK_END)
+        self.assertEqual(stored.read(), self.data[-10:])
+        stored.seek(-20, os.SEEK_CUR)
+        self.assertEqual(stored.tell(), len(self.data) - 20)
+        self.assertEqual(stored.read(5), self.data[-20:-15])
+
+    def test_seek_with_known_size(self):
+        self.check_seeks(self.open(size=len(self.data)))
+
+    def test_seek_from_the_end_without_size(self):
+        self.check_seeks(self.open())
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_zstd(self):
+        self.check_seeks(self.open(ZSTD))
+
+    @unittest.skipIf(load_workbook is None, "openpyxl is not installed")
+    def test_compressed_workbook_can_be_read(self):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        workbook.active.append(["name", "value"])
+        workbook.active.append(["a", 1])
+        saved = io.BytesIO()
+        workbook.save(saved)
+        self.data = saved.getvalue()
+        rows = list(iter_xlsx_rows(self.open()))
+        self.assertEqual(rows, [["name", "value"], ["a", 1]])
+
+    def test_django_file_api(self):
+        stored = self.open()
+        self.assertIsInstance(stored, File)
+        self.assertEqual(stored.size, len(self.data))
+        self.assertEqual(stored.tell(), 0)
+        self.assertEqual(b"".join(stored.chunks(1000)), self.data)
+        self.assertTrue(stored.multiple_chunks(1000))
+        self.assertEqual(DecompressingFile(io.BytesIO(), GZIP, name="packed.csv").name, "packed.csv")
+
+    def test_compressed_bytes_are_not_exposed(self):
+        with self.assertRaises(io.UnsupportedOperation):
+            self.open().fileno()
+
+    def test_precompressed_formats_are_not_compressed(self):
+        with mock.patch("cbh_core_model.uploads.FLOWJS_COMPRESS_UPLOADS", True):
+            self.assertEqual(default_compression(".XLSX"), "")
+            self.assertEqual(default_compression(".png"), "")
+            self.assertNotEqual(default_compression(".csv"), "")
+
+
+class TestChunkIngestionPool(SimpleTestCase):
+
+    def test_result_and_errors_are_returned_to_the_caller(self):
+        pool = ChunkIngestionPool(workers=1, max_pending=2)
+        self.assertEqual(pool.submit(lambda: 3).wait(5), 3)
+        with self.assertRaises(ZeroDivisionError):
+            pool.submit(lambda: 1 / 0).wait(5)
+
+    def test_pending_chunks_are_bounded(self):
+        pool = ChunkIngestionPool(workers=1, max_pending=1)
+        release = threading.Event()
+        pending = pool.submit(release.wait, 5)
+        with self.assertRaises(UploadBackpressure):
+            pool.submit(lambda: None)
+        release.set()
+        pending.wait(5)
+        self.assertIsNotNone(pool.submit(lambda: 1).wait(5))
+
+    def test_detached_chunk_outlives_the_request_file(self):
+        uploaded = TemporaryUploadedFile("chunk", "application/octet-stream", 5, None)
+        uploaded.write(b"bytes")
+        uploaded.flush()
+        chunk = DetachedChunk(uploaded)
+        #Django closes, and so deletes, the uploaded files when the request finishes
+        uploaded.close()
+        with chunk.open("chunk") as data:
+            self.assertEqual(data.read(), b"bytes")
+        chunk.discard()
+        self.assertFalse(os.path.exists(chunk.path))
+
+
+class SharedConnectionIngestionPool(ChunkIngestionPool):
+    """Ingestion pool whose thread uses the database connection of the test, as the in memory
+    sqlite test database is not shared between connections"""
+
+    def __init__(self, shared_connection):
+        super(SharedConnectionIngestionPool, self).__init__(workers=1)
+        self.shared_connection = shared_connection
+
+    def _run(self):
+        connections["default"] = self.shared_connection
+        super(SharedConnectionIngestionPool, self)._run()
+
+
+class TestIngestChunk(FlowFileTestCase):
+
+    def setUp(self):
+        super(TestIngestChunk, self).setUp()
+        connection.allow_thread_sharing = True
+        self.ingestor = mock.patch("cbh_core_model.models.get_chunk_ingestor", 
+            return_value=SharedConnectionIngestionPool(connections["default"]))
+        self.ingestor.start()
+
+    def test_waits_for_the_chunk_to_be_recorded(self):
+        flow_file = self.create_flow_file(total_chunks=2)
+        self.assertEqual(flow_file.ingest_chunk(1, SimpleUploadedFile("chunk", b"first")), 1)
+        self.assertEqual(flow_file.missing_chunks(), [2])
+        self.assertEqual(list(flow_file.chunks.values_list("number", flat=True)), [1])
+
+    def test_write_errors_reach_the_caller(self):
+        flow_file = self.create_flow_file(total_chunks=2)
+        with mock.patch.object(CBHFlowFile, "receive_chunk", side_effect=IOError("disk full")):
+            with self.assertRaises(IOError):
+                flow_file.ingest_chunk(1, SimpleUploadedFile("chunk", b"first"))
+        self.assertEqual(flow_file.missing_chunks(), [1, 2])
+
+    def tearDown(self):
+        self.ingestor.stop()
+        connection.allow_thread_sharing = False
+        super(TestIngestChunk, self).tearDown()
+
+
+class TestDeduplication(FlowFileTestCase):
+
+    def setUp(self):
+        super(TestDeduplication, self).setUp()
+        self.deduplicate = mock.patch("cbh_core_model.models.FLOWJS_DEDUPLICATE_UPLOADS", True)
+        self.deduplicate.start()
+
+    def test_off_by_default(self):
+        self.deduplicate.stop()
+        flow_file = self.upload("plain", [b"a,b\n", b"1,2\n"])
+        self.deduplicate.start()
+        self.assertIsNone(flow_file.storage_path)
+        self.assertIsNone(CBHFlowFile.objects.get(pk=flow_file.pk).sha256)
+
+    def test_identical_uploads_share_the_stored_copy(self):
+        first = self.upload("first", [b"a,b\n", b"1,2\n"])
+        second = self.upload("second", [b"a,b\n1,", b"2\n"])
+        self.assertEqual(first.sha256, hashlib.sha256(b"a,b\n1,2\n").hexdigest())
+        self.assertEqual(CBHFlowFile.objects.get(pk=second.pk).storage_path, first.storage_path)
+        self.assertEqual(list(second.duplicates()), [CBHFlowFile.objects.get(pk=first.pk)])
+
+        CBHFlowFile.objects.get(pk=first.pk).delete()
+        self.assertTrue(default_storage.exists(second.storage_path))
+        CBHFlowFile.objects.get(pk=second.pk).delete()
+        self.assertFalse(default_storage.exists(second.storage_path))
+
+    def test_orphaned_content_is_replaced(self):
+        first = self.upload("first", [b"a,b\n", b"1,2\n"])
+        #the row is gone but the stored copy was left behind
+        CBHFlowFile.objects.filter(pk=first.pk).delete()
+        with open(default_storage.path(first.storage_path), "wb") as stored:
+            stored.write(b"stale")
+        second = self.upload("second", [b"a,b\n", b"1,2\n"])
+        with second.file as stored:
+            self.assertEqual(stored.read(), b"a,b\n1,2\n")
+
+    def tearDown(self):
+        self.deduplicate.stop()
+        super(TestDeduplication, self).tearDown()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_validation
+---------------
+
+Tests for validating uploads with `cbh_core_model.validation`.
+"""
+import mock
+
+from django.test import SimpleTestCase
+
+from cbh_core_model.models import PinnedCustomField, validate_value, test_int, test_number, test_percentage, \
+    test_stringdate
+from cbh_core_model import validation
+
+
+def make_fields():
+    return [
+        PinnedCustomField(name="Name", field_type=PinnedCustomField.TEXT, required=True),
+        PinnedCustomField(name="Count", field_type=PinnedCustomField.INTEGER, required=False),
+        PinnedCustomField(name="Purity", field_type=PinnedCustomField.PERCENTAGE, required=False),
+    ]
+
+
+class TestValidateValue(SimpleTestCase):
+
+    def test_required_values_must_be_set(self):
+        for value in (None, ""):
+            self.assertFalse(validate_value(test_number, True, value))
+
+    def test_empty_values_are_valid_for_optional_fields(self):
+        for test_datatype in (test_int, test_number, test_percentage):
+            self.assertTrue(validate_value(test_datatype, False, None))
+            self.assertTrue(validate_value(test_datatype, False, ""))
+
+    def test_type_tests_reject_values_of_the_wrong_type(self):
+        for test_datatype in (test_int, test_number, test_percentage):
+            self.assertFalse(test_datatype(None))
+            self.assertFalse(test_datatype([1]))
+
+    def test_percentage(self):
+        self.assertTrue(test_percentage("50"))
+        self.assertFalse(test_percentage("150"))
+        self.assertFalse(test_percentage("abc"))
+
+    def test_stringdate(self):
+        self.assertEqual(test_stringdate("3 March 2016"), "2016-03-03")
+        self.assertFalse(test_stringdate("not a date"))
+
+    def test_int(self):
+        self.assertTrue(test_int("3"))
+        self.assertFalse(test_int("3.5"))
+
+
+class TestValidateUpload(SimpleTestCase):
+
+    def setUp(self):
+        self.fields = make_fields()
+        #Every seventh row has a bad count and every eleventh row is missing its required name
+        self.rows = []
+        for index in range(100):
+            row = {"Name": "row %d" % index, "Count": str(index), "Purity": ""}
+            if index % 7 == 0:
+                row["Count"] = "many"
+            if index % 11 == 0:
+                row["Name"] = ""
+            self.rows.append(row)
+
+    def test_errors_are_in_row_order(self):
+        errors = validation.validate_upload(self.fields, self.rows, workers=1)
+        self.assertEqual([(error["row"], error["field"]) for error in errors][:4],
+            [(0, "Name"), (0, "Count"), (7, "Count"), (11, "Name")])
+        self.assertEqual(len(errors), len(range(0, 100, 7)) + len(range(0, 100, 11)))
+
+    def test_blocks_cover_every_row_once(self):
+        blocks = list(validation._iter_blocks(self.rows, 30))
+        self.assertEqual([start for start, rows in blocks], [0, 30, 60, 90])
+        self.assertEqual(sum((rows for start, rows in blocks), []), self.rows)
+
+    def test_pool_matches_serial_validation(self):
+        serial = validation.validate_upload(self.fields, self.rows, workers=1)
+        with mock.patch.object(validation, "VALIDATION_SERIAL_THRESHOLD", 0):
+            pooled = validation.validate_upload(self.fields, self.rows, workers=2, block_rows=30)
+        self.assertEqual(pooled, serial)